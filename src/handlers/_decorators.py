@@ -1,42 +1,80 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from functools import wraps
+from functools import partial, wraps
 from utils.rate_limiter import RateLimiter
 from datetime import datetime, timezone
 from config import CMD_FOR_PREMIUM_TEXT
-from utils.general import get_db
+from utils.general import get_db, get_user_record
+from utils.metrics import track_update
 
 
-def rate_counter(func):
+def rate_counter(func=None, *, cost: int = 1, quota: str = None):
+    """
+    Count the update against the user's daily budget. Expensive handlers declare a
+    cost in budget units and/or a quota ("llm", "scan") with its own daily cap:
+
+        @rate_counter
+        @rate_counter(cost=10, quota="scan")
+    """
+    if func is None:
+        return partial(rate_counter, cost=cost, quota=quota)
+
     @wraps(func)
     async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        _allowed_reqs = context.bot_data["requests_per_day"]
-        is_admin = update.effective_user.id in context.bot_data["admins"]
-        def_allowed = _allowed_reqs * 20 if is_admin else _allowed_reqs
+        # Storage capacity and latency of the whole update are logged under the handler
+        with track_update(func.__name__):
+            _allowed_reqs = context.bot_data["requests_per_day"]
+            is_admin = update.effective_user.id in context.bot_data["admins"]
+            factor = 20 if is_admin else 1
+            def_allowed = _allowed_reqs * factor
+            quota_caps = {
+                kind: n * factor for kind, n in context.bot_data.get("quotas_per_day", {}).items()
+            }
+            db = get_db(context)
 
-        rlim = RateLimiter(
-            update.effective_user.id,
-            context.bot.id,
-            context.bot_data["db"],
-            max_reqs_allowed=def_allowed,
-        )
-        rlim.get_current_reqs()
-        n_warns = rlim.max_reqs_allowed + 5
-        is_max = rlim.is_max_reached()
-        if update.callback_query:
-            ans_func = update.callback_query.edit_message_text
-        else:
-            ans_func = update.effective_user.send_message
-        if not is_max:
-            await func(update, context)
-        elif is_max and rlim.daily_requests < n_warns:
-            await ans_func(
-                f"⚠️ <b>Limit reached!</b> Try again in <b>{rlim.get_time_until_reset()}</b> ⏳",
-                parse_mode="HTML",
+            # Single Users-table read shared by the limiter and the handler
+            record = await db.load_user_record(update.effective_user.id, context.bot.id)
+            context.user_record = record
+
+            rlim = RateLimiter(
+                update.effective_user.id,
+                context.bot.id,
+                db,
+                max_reqs_allowed=def_allowed,
+                store=context.bot_data.get("rate_store"),
+                mode=context.bot_data.get("rate_limit_mode", "db"),
+                cost=cost,
+                quota_caps=quota_caps,
             )
-        else:
-            pass
-        rlim.update_db_reqs()
+            context.rate_limiter = rlim
+            await rlim.get_current_reqs(record)
+            n_warns = rlim.warn_limit
+            is_max = rlim.is_max_reached()
+            if update.callback_query:
+                ans_func = update.callback_query.edit_message_text
+            else:
+                ans_func = update.effective_user.send_message
+            try:
+                if not is_max and quota and not rlim.use_quota(quota, record):
+                    # Refused updates count as one request, not the command's cost
+                    await rlim.refuse(record)
+                    await ans_func(
+                        f"⚠️ <b>Daily limit reached</b> for this command. Try again in <b>{rlim.get_time_until_reset()}</b> ⏳",
+                        parse_mode="HTML",
+                    )
+                elif not is_max:
+                    await func(update, context)
+                else:
+                    await rlim.refuse(record)
+                    if rlim.daily_requests < n_warns:
+                        await ans_func(
+                            f"⚠️ <b>Limit reached!</b> Try again in <b>{rlim.get_time_until_reset()}</b> ⏳",
+                            parse_mode="HTML",
+                        )
+            finally:
+                # Counters and every field staged by the handler go out in one UpdateItem
+                await rlim.update_db_reqs(record)
+                await db.flush_user_record(record)
 
     return wrapper
 
@@ -65,8 +103,12 @@ def check_premium_or_admin(func):
             await func(update, context)
         else:
             db = get_db(context)
-            fields = db.get_fields(
-                update.effective_user.id, context.bot.id, ["is_premium", "end_premium"]
+            record = get_user_record(context)
+            fields = await db.get_fields(
+                update.effective_user.id,
+                context.bot.id,
+                ["is_premium", "end_premium"],
+                record=record,
             )
             is_premium = fields.get("is_premium")
             end_premium = fields.get("end_premium")
@@ -74,7 +116,7 @@ def check_premium_or_admin(func):
             if not is_premium:
                 await ans_func(CMD_FOR_PREMIUM_TEXT, parse_mode="HTML")
             elif is_premium and end_premium < current_time:
-                db.update_multiple_fields(
+                await db.update_multiple_fields(
                     update.effective_user.id,
                     context.bot.id,
                     {
@@ -82,6 +124,7 @@ def check_premium_or_admin(func):
                         "end_premium": "",
                         "premium_plan": "",
                     },
+                    record=record,
                 )
             else:
                 await func(update, context)
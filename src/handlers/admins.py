@@ -1,7 +1,8 @@
 from telegram import Update
 from telegram.ext import ContextTypes
 from handlers._decorators import admin_only, rate_counter
-from utils.general import get_db
+from utils.general import get_db, get_user_record
+from utils.metrics import METER
 
 
 @rate_counter
@@ -11,9 +12,9 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     msg = """
 📋 <b>Admin Commands Help</b>:
 
-<b>/empty_user_data</b> - Delete all records for yourself.
+<b>/empty_user_data</b> - Delete all records for yourself. Add <code>account</code> to also delete your profile, or <code>start end [category]</code> to delete a date range.
 
-<b>/usage</b> - Get usage stats for a given user or for all.
+<b>/usage</b> - Get usage stats for a given user or for all. <code>/usage db</code> shows storage capacity and latency by handler.
 
 <b>/broadcast</b> - Send a message to all bot users.
 
@@ -25,13 +26,39 @@ async def admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
 @rate_counter
 @admin_only
 async def empty_user_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Delete all records for a specific user."""
+    """
+    Delete your own records:
+    /empty_user_data                          all expenses
+    /empty_user_data account                  expenses, rollups and user profile
+    /empty_user_data <start> <end> [category] expenses in a date range (YYYY-MM-DD)
+    """
     db = get_db(context)
     user_id = str(update.effective_user.id)
+    record = get_user_record(context)
+    args = context.args or []
     try:
-        records = db.fetch_expenses_by_user_and_date(user_id, "1900-01-01", "2100-12-31")
-        db.remove_batch_records(records)
-        await update.message.reply_text(f"✅ Deleted {len(records)} records for user {user_id}")
+        if args == ["account"]:
+            deleted = await db.delete_account(user_id, context.bot.id)
+            record.mark_deleted()
+        elif not args:
+            deleted = await db.purge_expenses(user_id)
+        elif len(args) in (2, 3):
+            category = None
+            if len(args) == 3:
+                cats = await db.get_fields(user_id, context.bot.id, "categories", record=record)
+                category = next(
+                    (k for k, v in (cats or {}).items() if args[2] in (k, v["name"])), None
+                )
+                if category is None:
+                    await update.message.reply_text(f"❌ Unknown category: {args[2]}")
+                    return
+            deleted = await db.purge_expenses(user_id, args[0], args[1], category)
+        else:
+            await update.message.reply_text(
+                "Usage: /empty_user_data [account | <start> <end> [category]]"
+            )
+            return
+        await update.message.reply_text(f"✅ Deleted {deleted} records for user {user_id}")
     except Exception as e:
         await update.message.reply_text(f"❌ Error deleting user data: {str(e)}")
 
@@ -44,17 +71,35 @@ async def usage(update: Update, context: ContextTypes.DEFAULT_TYPE):
     owner = str(context.bot_data["owner"])
     args = context.args
     try:
-        if args:
+        if args == ["db"]:
+            # Storage cost by handler, for this container since it started
+            rows = METER.report()
+            msg = "📊 Storage usage by handler (this instance):\n\n" + (
+                "\n".join(
+                    f"{r['handler']}: {r['updates']} updates, {r['calls']} calls, "
+                    f"{r['rcu']} RCU, {r['wcu']} WCU, {r['db_ms']} ms"
+                    for r in rows
+                )
+                or "No storage calls recorded yet."
+            )
+        elif args:
             if args[0] != "me":
                 user_id = str(args[0])
             else:
                 user_id = owner
-            records = db.fetch_expenses_by_user_and_date(user_id, "1900-01-01", "2100-12-31")
+            n_records = 0
+            first_date = None
+            last_date = None
+            async for page in db.iter_expenses(
+                user_id, "1900-01-01", "2100-12-31", fields=["date"]
+            ):
+                # Pages come in date order
+                first_date = first_date or page[0]["date"]
+                last_date = page[-1]["date"]
+                n_records += len(page)
             msg = f"📊 Stats for user {user_id}:\n"
-            msg += f"Total records: {len(records)}\n"
-            if records:
-                first_date = min(r["date"] for r in records)
-                last_date = max(r["date"] for r in records)
+            msg += f"Total records: {n_records}\n"
+            if n_records:
                 msg += f"First record: {first_date}\n"
                 msg += f"Last record: {last_date}"
         else:
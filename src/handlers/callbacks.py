@@ -1,12 +1,13 @@
+from collections import defaultdict
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice
 from telegram.ext import ContextTypes
 
-from utils.general import get_db, get_active_categories
-from utils.stats_format import graph_weekly_expenses
+from utils.general import get_db, get_active_categories, get_user_record
+from utils.stats_format import graph_expenses_by_date
 from utils.dates import parse_timezone, parse_city_timezone
 from utils import keyboards as kb
-from utils.db import ExpenseDB
+from utils.async_db import AsyncExpenseDB
 from handlers._decorators import rate_counter, check_premium_or_admin
 import re
 from config import (
@@ -19,6 +20,8 @@ from config import (
     ST_WAIT_CATEGORY,
 )
 
+# Attributes the history listing shows
+HISTORY_FIELDS = ["date", "amount", "category", "description"]
 
 # ##############################################################
 # Shared (don't count for rate limiting)
@@ -35,7 +38,11 @@ async def _show_categories_to_manage(update: Update, context: ContextTypes.DEFAU
     try:
         act_cats = {
             k: v
-            for k, v in get_active_categories(db, update.effective_user.id, context.bot.id).items()
+            for k, v in (
+                await get_active_categories(
+                    db, update.effective_user.id, context.bot.id, record=get_user_record(context)
+                )
+            ).items()
             if not re.match(r"(?i).*(income|other)$", v["name"])
         }
         can_add = len(act_cats) < MAX_CATEGORIES
@@ -71,7 +78,12 @@ async def _ai_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else update.message.reply_text
     )
     db = get_db(context)
-    is_ai = db.get_fields(update.effective_user.id, context.bot.id, "artificial_intelligence")
+    is_ai = await db.get_fields(
+        update.effective_user.id,
+        context.bot.id,
+        "artificial_intelligence",
+        record=get_user_record(context),
+    )
     if is_ai:
         msg = "🟢 AI is currently enabled for your expenses"
     else:
@@ -88,10 +100,10 @@ async def help_premium(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def _get_stats_report(
-    db: ExpenseDB, window: str, user_id: str, bot_id: str, cutoff_date=None
+    db: AsyncExpenseDB, window: str, user_id: str, bot_id: str, cutoff_date=None, record=None
 ):
     stats_window = window
-    str_tz = db.get_fields(user_id, bot_id, "user_timezone")
+    str_tz = await db.get_fields(user_id, bot_id, "user_timezone", record=record)
     tz = parse_timezone(str_tz)
     if cutoff_date is not None:
         try:
@@ -111,28 +123,9 @@ async def _get_stats_report(
 
         if stats_window in time_windows:
             start_date, end_date = time_windows[stats_window]
-            data = db.fetch_expenses_by_user_and_date(user_id, start_date, end_date)
         else:
             return f"Invalid time window: {stats_window}"
 
-        if not data:
-            return "No records found for the selected time window."
-
-        cats = db.get_fields(user_id, bot_id, "categories")
-        exp = []
-        inc = []
-        exp_total = 0
-        inc_total = 0
-        for i in data:
-            i["category"] = cats[i["category"]]["name"]
-            if not re.search(r"(?i).*income", i["category"]):
-                exp.append(i)
-                exp_total += i["amount"]
-                exp
-            else:
-                inc.append(i)
-                inc_total += i["amount"]
-
         _map = {
             "Today": "daily",
             "This Week": "daily",
@@ -140,8 +133,37 @@ async def _get_stats_report(
             "This Year": "monthly",
             "All Time": "monthly",
         }
-        if exp:
-            msg = graph_weekly_expenses(exp, window=_map[stats_window], max_bars=10)
+        # Pre-aggregated day/month rollups: O(periods) reads instead of O(records)
+        granularity = "D" if _map[stats_window] == "daily" else "M"
+        cats = await db.get_fields(user_id, bot_id, "categories", record=record) or {}
+        await db.ensure_rollups(user_id)
+        exp_by_date = defaultdict(float)
+        n_exp = 0
+        n_inc = 0
+        exp_total = 0
+        inc_total = 0
+        async for i in db.iter_rollups(user_id, granularity, start_date, end_date):
+            period_date = i["period"][2:] if granularity == "D" else f"{i['period'][2:]}-01"
+            for counter, value in i.items():
+                if not counter.startswith("cat_"):
+                    continue
+                cat_id = counter[4:]
+                count = int(i.get(f"cnt_{cat_id}", 0))
+                name = cats.get(cat_id, {}).get("name", "")
+                if not re.search(r"(?i).*income", name):
+                    if count:
+                        exp_by_date[period_date] += float(value)
+                    exp_total += value
+                    n_exp += count
+                else:
+                    inc_total += value
+                    n_inc += count
+
+        if not n_exp and not n_inc:
+            return "No records found for the selected time window."
+
+        if exp_by_date:
+            msg = graph_expenses_by_date(exp_by_date, window=_map[stats_window], max_bars=10)
         else:
             msg = "No expenses to show.\n"
 
@@ -150,8 +172,8 @@ async def _get_stats_report(
         return f"""
                 📊 <b>Stats for {stats_window}</b>:\n
 <b>➖ Expenses</b>\n\n{msg}\n
-<b>Total Expenses: <code>${exp_total:,.2f}</code></b> ({len(exp)})\n
-<b>Total Income: <code>${inc_total:,.2f}</code></b> ({len(inc)})\n\n
+<b>Total Expenses: <code>${exp_total:,.2f}</code></b> ({n_exp})\n
+<b>Total Income: <code>${inc_total:,.2f}</code></b> ({n_inc})\n\n
 <b>Total Net: <code>{sign}${abs(net):,.2f}</code></b>
                 """
 
@@ -181,7 +203,9 @@ async def settings_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     is_pt2 = query.data.split(":")[-1] == "pt2"
     db = get_db(context)
-    tz = db.get_fields(update.effective_user.id, context.bot.id, "user_timezone")
+    tz = await db.get_fields(
+        update.effective_user.id, context.bot.id, "user_timezone", record=get_user_record(context)
+    )
     tz_city = parse_city_timezone(tz)
     with_reset = True if tz != "UTC-6" else False
     await query.edit_message_text(
@@ -196,7 +220,13 @@ async def settings_timezone_reset(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     await query.edit_message_text("✅ Timezone reset to default.")
     db = get_db(context)
-    db.update_field(update.effective_user.id, context.bot.id, "user_timezone", "UTC-6")
+    await db.update_field(
+        update.effective_user.id,
+        context.bot.id,
+        "user_timezone",
+        "UTC-6",
+        record=get_user_record(context),
+    )
 
 
 @rate_counter
@@ -205,7 +235,13 @@ async def settings_timezone_confirm(update: Update, context: ContextTypes.DEFAUL
     db = get_db(context)
     tz_id = query.data.split(":")[-1]
     await query.edit_message_text("✅ Timezone updated successfully.")
-    db.update_field(update.effective_user.id, context.bot.id, "user_timezone", tz_id)
+    await db.update_field(
+        update.effective_user.id,
+        context.bot.id,
+        "user_timezone",
+        tz_id,
+        record=get_user_record(context),
+    )
 
 
 @rate_counter
@@ -247,7 +283,13 @@ async def ai_change_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text(
         f"✅ AI has been <b>{st_txt}</b> for your expenses.", parse_mode="HTML"
     )
-    db.update_field(update.effective_user.id, context.bot.id, "artificial_intelligence", new_active)
+    await db.update_field(
+        update.effective_user.id,
+        context.bot.id,
+        "artificial_intelligence",
+        new_active,
+        record=get_user_record(context),
+    )
 
 
 # ##############################################################
@@ -268,13 +310,14 @@ async def history_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-@rate_counter
+@rate_counter(cost=2)
 async def history_windows(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = get_db(context)
     query = update.callback_query
     window = query.data.split(":")[-1]
     user_id = str(query.from_user.id)
-    str_tz = db.get_fields(user_id, context.bot.id, "user_timezone")
+    record = get_user_record(context)
+    str_tz = await db.get_fields(user_id, context.bot.id, "user_timezone", record=record)
     tz = parse_timezone(str_tz)
     today_dt = datetime.now(tz)
 
@@ -286,13 +329,13 @@ async def history_windows(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     try:
         if window in ["Today", "This Week", "This Month"]:
-            data = db.fetch_expenses_by_user_and_date(
-                user_id, start_dt[window], today_dt, ascending=False
+            data = await db.fetch_expenses_by_user_and_date(
+                user_id, start_dt[window], today_dt, ascending=False, fields=HISTORY_FIELDS
             )
         elif window == "Previous Month":
             last_day_dt = today_dt.replace(day=1) - timedelta(days=1)
-            data = db.fetch_expenses_by_user_and_date(
-                user_id, start_dt[window], last_day_dt, ascending=False
+            data = await db.fetch_expenses_by_user_and_date(
+                user_id, start_dt[window], last_day_dt, ascending=False, fields=HISTORY_FIELDS
             )
         else:
             await query.edit_message_text(f"Invalid time window: {window}")
@@ -302,7 +345,7 @@ async def history_windows(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("No records found for the selected time window.")
             return
 
-        cats = db.get_fields(user_id, context.bot.id, "categories")
+        cats = await db.get_fields(user_id, context.bot.id, "categories", record=record)
 
         entries = [
             f"{item['date']}: <code>${item['amount']:,.2f}</code> - {cats[item['category']]['name']}"
@@ -349,13 +392,15 @@ async def stats_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-@rate_counter
+@rate_counter(cost=2)
 async def stats_windows(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = get_db(context)
     query = update.callback_query
     stats_window = query.data.split(":")[-1]
     user_id = str(query.from_user.id)
-    msg = await _get_stats_report(db, stats_window, user_id, context.bot.id)
+    msg = await _get_stats_report(
+        db, stats_window, user_id, context.bot.id, record=get_user_record(context)
+    )
     await query.edit_message_text(
         msg,
         parse_mode="HTML",
@@ -380,9 +425,10 @@ async def expense_confirm_category(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     user_id = str(query.from_user.id)
     cat_id = query.data.split(":")[-1]
+    record = get_user_record(context)
     try:
-        _data = db.get_fields(
-            user_id, context.bot.id, ["temp_data", "categories", "user_timezone"]
+        _data = await db.get_fields(
+            user_id, context.bot.id, ["temp_data", "categories", "user_timezone"], record=record
         )  # Get temp data
         state = _data.get("temp_data")
         cats = _data.get("categories")
@@ -399,7 +445,7 @@ async def expense_confirm_category(update: Update, context: ContextTypes.DEFAULT
         )
 
         # Store
-        db.insert_expense(
+        await db.insert_expense(
             user_id=user_id,
             amount=amount,
             category=str(cat_id),
@@ -409,7 +455,7 @@ async def expense_confirm_category(update: Update, context: ContextTypes.DEFAULT
             timezone=tz,
         )
         # Reset temp data
-        db.update_field(user_id, context.bot.id, "temp_data", {})
+        await db.update_field(user_id, context.bot.id, "temp_data", {}, record=record)
     except Exception as e:
         await query.edit_message_text(f"Error inserting record: {str(e)}")
 
@@ -427,15 +473,21 @@ async def confirm_delete_expense(update: Update, context: ContextTypes.DEFAULT_T
     user_id = str(query.from_user.id)
     expense_id = query.data.split(":")[-1]
     try:
-        item = db.table.get_item(Key={"user_id": str(user_id), "timestamp": expense_id}).get("Item")
+        # The confirmation is rendered from the deleted item
+        item = await db.remove_expense(user_id, expense_id)
+        if item is None:
+            await query.edit_message_text("This record was already deleted.")
+            return
         cat_id = item["category"]
-        cat_name = db.get_fields(user_id, context.bot.id, "categories")[cat_id]["name"]
+        cats = await db.get_fields(
+            user_id, context.bot.id, "categories", record=get_user_record(context)
+        )
+        cat_name = cats[cat_id]["name"]
         txt = f"{item['date']}: <code>${item['amount']:,.2f}</code> - {cat_name}" + (
-            f" ({item['description']})" if item["description"] else ""
+            f" ({item['description']})" if item.get("description") else ""
         )
 
         await query.edit_message_text(f"🗑 <b>Deleted</b>:\n {txt}", parse_mode="HTML")
-        db.remove_expense(user_id, expense_id)
     except Exception as e:
         await query.edit_message_text(f"Error removing record: {str(e)}")
 
@@ -505,8 +557,12 @@ async def add_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.edit_message_text(
         f"Please send the name of the new category. It should be unique and not exceed {MAX_CAT_LENGTH} characters."
     )
-    db.update_field(
-        update.effective_user.id, context.bot.id, "conversation_status", ST_WAIT_CATEGORY
+    await db.update_field(
+        update.effective_user.id,
+        context.bot.id,
+        "conversation_status",
+        ST_WAIT_CATEGORY,
+        record=get_user_record(context),
     )
 
 
@@ -515,15 +571,17 @@ async def reset_categories(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = get_db(context)
     user_id = str(update.effective_user.id)
     bot_id = str(context.bot.id)
+    record = get_user_record(context)
     try:
-        categories = db.get_fields(user_id, bot_id, "categories")
-        for cat_id, _ in categories.items():
-            if cat_id in DEFAULT_CATEGORIES:
-                categories[cat_id]["active"] = 1
-            else:
-                categories[cat_id]["active"] = 0
+        categories = await db.get_fields(user_id, bot_id, "categories", record=record)
+        # Only the flags that change are written
+        states = {
+            cat_id: int(cat_id in DEFAULT_CATEGORIES)
+            for cat_id, cat in categories.items()
+            if cat["active"] != int(cat_id in DEFAULT_CATEGORIES)
+        }
+        await db.set_categories_active(user_id, bot_id, states, record=record)
         await update.callback_query.edit_message_text("Categories have been reset to default.")
-        db.update_field(user_id, bot_id, "categories", categories)
     except Exception as e:
         await update.callback_query.edit_message_text(f"Error resetting categories: {str(e)}")
 
@@ -535,7 +593,11 @@ async def delete_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         cats = {
             k: v
-            for k, v in get_active_categories(db, update.effective_user.id, context.bot.id).items()
+            for k, v in (
+                await get_active_categories(
+                    db, update.effective_user.id, context.bot.id, record=get_user_record(context)
+                )
+            ).items()
             if not re.match(r"(?i).*(income|other)$", v["name"])
         }
         await query.edit_message_text(
@@ -550,10 +612,14 @@ async def confirm_delete_category(update: Update, context: ContextTypes.DEFAULT_
     query = update.callback_query
     db = get_db(context)
     deleted_id = query.data.split(":")[-1]
-    cats = db.get_fields(update.effective_user.id, context.bot.id, "categories")
+    record = get_user_record(context)
+    cats = await db.get_fields(
+        update.effective_user.id, context.bot.id, "categories", record=record
+    )
+    await db.set_categories_active(
+        update.effective_user.id, context.bot.id, {deleted_id: 0}, record=record
+    )
     await query.edit_message_text(f"🗑 Category {cats[deleted_id]['name']} was deleted.")
-    cats[deleted_id]["active"] = 0
-    db.update_field(update.effective_user.id, context.bot.id, "categories", cats)
 
 
 @rate_counter
@@ -9,7 +9,7 @@ from utils.keyboards import (
     get_help_keyboard,
     get_premium_keyboard,
 )
-from utils.general import truncate, get_db
+from utils.general import truncate, get_db, get_user_record
 from handlers.callbacks import _show_categories_to_manage
 from utils.dates import parse_timezone, get_str_timestamp
 
@@ -43,13 +43,11 @@ async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
     bot_id = str(context.bot.id)
 
-    # Check if the user and bot already exist in the table
-    existing_user = db.users_table.get_item(Key={"user_id": user_id, "bot_id": bot_id}).get("Item")
-
-    if not existing_user:
+    # rate_counter already loaded the user, so existence needs no extra read
+    if not get_user_record(context).exists:
         curr_time = get_str_timestamp()
-        db.users_table.put_item(
-            Item={
+        await db.put_user(
+            {
                 "user_id": user_id,
                 "bot_id": bot_id,
                 "username": update.effective_user.username or "",
@@ -96,7 +94,7 @@ async def premium_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     value = context.args[0].lower()
     if value == context.bot_data["special_prefix"] + ":" + "deactivate":
         db = get_db(context)
-        db.update_multiple_fields(
+        await db.update_multiple_fields(
             update.effective_user.id,
             context.bot.id,
             {
@@ -104,6 +102,7 @@ async def premium_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 "end_premium": "",
                 "premium_plan": "",
             },
+            record=get_user_record(context),
         )
         await update.message.reply_text("✅ Premium deactivated.")
     elif value.startswith(context.bot_data["special_prefix"] + ":"):
@@ -117,12 +116,16 @@ async def delete_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         n = 10
-        records = db.fetch_latest_expenses(user_id, n)
+        records = await db.fetch_latest_expenses(
+            user_id, n, fields=["timestamp", "date", "amount", "category", "description"]
+        )
         if not records:
             await update.message.reply_text("No records found to delete.")
             return
         # Build message body
-        cats = db.get_fields(user_id, context.bot.id, "categories")
+        cats = await db.get_fields(
+            user_id, context.bot.id, "categories", record=get_user_record(context)
+        )
         history = [
             f"{item['date']} - ${item['amount']:,.2f} - {cats[item['category']]['name']}"
             + (f" ({truncate(item['description'])})" if item.get("description") else "")
@@ -164,35 +167,43 @@ async def categories_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
     await _show_categories_to_manage(update, context)
 
 
-@rate_counter
+@rate_counter(cost=10, quota="scan")
 @check_premium_or_admin
 async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = get_db(context)
     user_id = str(update.effective_user.id)
     try:
-        # Fetch all records for the user
-        records = db.fetch_expenses_by_user_and_date(user_id, "1950-01-01", "2100-12-31")
         await update.message.reply_text("🟡 Exporting your data...")
-        if not records:
-            await update.message.reply_text("⚠️ No records found to export.")
-            return
 
-        # Create in memory CSV
+        # Create in memory CSV, streaming the history page by page
         output = io.StringIO()
         writer = csv.writer(output)
 
         writer.writerow(["Date", "Amount", "Category", "Description", "Income"])
-        cats = db.get_fields(user_id, context.bot.id, "categories")
-        for record in records:
-            writer.writerow(
-                [
-                    record["date"],
-                    record["amount"],
-                    cats[record["category"]]["name"],
-                    record.get("description", ""),
-                    "Yes" if record["income"] else "No",
-                ]
-            )
+        cats = await db.get_fields(
+            user_id, context.bot.id, "categories", record=get_user_record(context)
+        )
+        n_records = 0
+        async for page in db.iter_expenses(
+            user_id,
+            "1950-01-01",
+            "2100-12-31",
+            fields=["date", "amount", "category", "description", "income"],
+        ):
+            for record in page:
+                writer.writerow(
+                    [
+                        record["date"],
+                        record["amount"],
+                        cats[record["category"]]["name"],
+                        record.get("description", ""),
+                        "Yes" if record["income"] else "No",
+                    ]
+                )
+            n_records += len(page)
+        if not n_records:
+            await update.message.reply_text("⚠️ No records found to export.")
+            return
         output.seek(0)
         file_dt = datetime.now(parse_timezone()).strftime("%Y_%m_%d")
         await update.message.reply_document(
@@ -235,11 +246,15 @@ async def last_n_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             n = 5
 
         # Fetch the last N records
-        records = db.fetch_latest_expenses(user_id, n)
+        records = await db.fetch_latest_expenses(
+            user_id, n, fields=["date", "amount", "category", "description"]
+        )
         if not records:
             await update.message.reply_text("No records found.")
             return
-        cats = db.get_fields(user_id, context.bot.id, "categories")
+        cats = await db.get_fields(
+            user_id, context.bot.id, "categories", record=get_user_record(context)
+        )
         history = "\n".join(
             f"{item['date']}: <code>${item['amount']:,.2f}</code> - {cats[item['category']]['name']}"
             + (f" ({item['description']})" if item["description"] else "")
@@ -9,9 +9,12 @@ from utils.general import (
     parse_msg_to_elements,
     get_active_categories,
     get_ai_client,
+    get_user_record,
     replace_all,
+    use_quota,
 )
 from handlers._decorators import rate_counter
+from utils.storage import ConditionFailed
 from config import ST_WAIT_CATEGORY, ST_REGULAR, LLM_TEMPLATE, MAX_CAT_LENGTH
 import uuid
 
@@ -24,6 +27,7 @@ async def _msg_regular(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Message too long. Please keep it under 100 characters.")
         return
     user_id = str(update.effective_user.id)
+    record = get_user_record(context)
 
     amount, description, is_income = await parse_msg_to_elements(update, text)
     _desc = f"<b>Description</b>: {description}" if description else ""
@@ -34,8 +38,8 @@ async def _msg_regular(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(
                 f"✅ Logged: <b>${amount:,.2f}</b> in <b>💰 Income</b>", parse_mode="HTML"
             )
-            tz = db.get_fields(user_id, context.bot.id, "user_timezone")
-            db.insert_expense(
+            tz = await db.get_fields(user_id, context.bot.id, "user_timezone", record=record)
+            await db.insert_expense(
                 user_id=user_id,
                 amount=amount,
                 category="99",  # Income category
@@ -48,8 +52,11 @@ async def _msg_regular(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"Error inserting income: {str(e)}")
     else:
         try:
-            fields = db.get_fields(
-                user_id, context.bot.id, ["artificial_intelligence", "categories", "user_timezone"]
+            fields = await db.get_fields(
+                user_id,
+                context.bot.id,
+                ["artificial_intelligence", "categories", "user_timezone"],
+                record=record,
             )
             is_ai_enabled = fields.get("artificial_intelligence")
             cats: dict = fields.get("categories")
@@ -60,11 +67,12 @@ async def _msg_regular(update: Update, context: ContextTypes.DEFAULT_TYPE):
             other_cat_name = [k for k in inverted_cats.keys() if re.match(r"(?i).*other", k)][0]
             other_cat_id = inverted_cats[other_cat_name]
             fmt_cats = "\n".join(act_cats.values())
-            if is_ai_enabled:
+            # Without LLM quota left the user picks the category as with AI disabled
+            if is_ai_enabled and use_quota(context, "llm"):
                 prompt = replace_all(
                     LLM_TEMPLATE, {"<<categories>>": fmt_cats, "<<description>>": description}
                 )
-                ai_cat = ai.generate_response(prompt)
+                ai_cat = await ai.agenerate_response(prompt)
                 if not ai_cat:
                     ai_cat_id = other_cat_id  # Default category
                     ai_cat = other_cat_name
@@ -76,7 +84,7 @@ async def _msg_regular(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     f"{pref}✅ Logged: <b>${amount:,.2f}</b> in <b>{ai_cat}</b>",
                     parse_mode="HTML",
                 )
-                db.insert_expense(
+                await db.insert_expense(
                     user_id=user_id,
                     amount=amount,
                     category=ai_cat_id,
@@ -86,23 +94,23 @@ async def _msg_regular(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     timezone=tz,
                 )
             else:
-                act_cats = get_active_categories(db, user_id, context.bot.id)
+                act_cats = await get_active_categories(db, user_id, context.bot.id, record=record)
                 await update.message.reply_text(
                     f"<b>Expense</b>: ${amount:,.2f}\n{_desc}\n" "Please select a category:",
                     parse_mode="HTML",
                     reply_markup=get_category_keyboard(act_cats),
                 )
 
-                db.users_table.update_item(
-                    Key={"user_id": user_id, "bot_id": str(context.bot.id)},
-                    UpdateExpression="SET temp_data = :tmp_data",
-                    ExpressionAttributeValues={
-                        ":tmp_data": {
-                            "pend_amt": Decimal(str(amount)),
-                            "pend_desc": description,
-                            "pend_inc": is_income,
-                        }
+                await db.update_field(
+                    user_id,
+                    context.bot.id,
+                    "temp_data",
+                    {
+                        "pend_amt": Decimal(str(amount)),
+                        "pend_desc": description,
+                        "pend_inc": is_income,
                     },
+                    record=record,
                 )
         except Exception as e:
             await update.message.reply_text(f"Error recording expense: {str(e)}")
@@ -113,34 +121,52 @@ async def _msg_custom_category(update: Update, context: ContextTypes.DEFAULT_TYP
     txt = update.message.text.strip()
     is_name_ok = not txt.startswith("/") and len(txt) <= MAX_CAT_LENGTH
     user_id = str(update.effective_user.id)
+    record = get_user_record(context)
     if is_name_ok:
-        cats = db.get_fields(user_id, context.bot.id, "categories")
+        cats = await db.get_fields(user_id, context.bot.id, "categories", record=record)
         # Seek if the category already existed
         for cat_id, cat_data in cats.items():
             if cat_data["name"] == txt:
-                cats[cat_id]["active"] = 1
-                db.update_field(update.effective_user.id, context.bot.id, "categories", cats)
+                await db.set_categories_active(user_id, context.bot.id, {cat_id: 1}, record=record)
                 await update.message.reply_text(f"Category '{txt}' reactivated.")
-                db.update_field(user_id, context.bot.id, "conversation_status", ST_REGULAR)
+                await db.update_field(
+                    user_id, context.bot.id, "conversation_status", ST_REGULAR, record=record
+                )
                 return
         # If not, create a new one
         new_cat_id = str(uuid.uuid4()).split("-")[0]
         new_category = {"name": txt, "active": 1}
-        cats[new_cat_id] = new_category
-        db.update_field(update.effective_user.id, context.bot.id, "categories", cats)
-        await update.message.reply_text(f"New category <b>'{txt}'</b> created.", parse_mode="HTML")
+        try:
+            await db.add_category(
+                user_id, context.bot.id, new_cat_id, new_category, len(cats), record=record
+            )
+            await update.message.reply_text(
+                f"New category <b>'{txt}'</b> created.", parse_mode="HTML"
+            )
+        except ConditionFailed:
+            await update.message.reply_text(
+                "⚠️ Your categories were changed meanwhile, please try again."
+            )
     else:
         await update.message.reply_text(
             "⚠️ The category name is too long, try again!",
             reply_markup=get_category_mgmt_menu(with_delete=False, with_reset=False),
         )
-    db.update_field(user_id, context.bot.id, "conversation_status", ST_REGULAR)
+    await db.update_field(user_id, context.bot.id, "conversation_status", ST_REGULAR, record=record)
 
 
 @rate_counter
 async def text_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     db = get_db(context)
-    status = db.get_fields(update.effective_user.id, context.bot.id, "conversation_status") or 0
+    status = (
+        await db.get_fields(
+            update.effective_user.id,
+            context.bot.id,
+            "conversation_status",
+            record=get_user_record(context),
+        )
+        or 0
+    )
     msg_hand_map = {
         ST_REGULAR: _msg_regular,
         ST_WAIT_CATEGORY: _msg_custom_category,
@@ -35,7 +35,7 @@ async def _activate_premium_plan(update: Update, context: ContextTypes.DEFAULT_T
         "premium_plan": plan,
     }
 
-    db.update_multiple_fields(update.effective_user.id, context.bot.id, updates=new_premium)
+    await db.update_multiple_fields(update.effective_user.id, context.bot.id, updates=new_premium)
     end_date_fmt = f"{end_date.strftime('%Y-%m-%d %H:%M')} UTC"
     await update.message.reply_text(
         f"✅ Premium activated until <b>{end_date_fmt}</b>", parse_mode="HTML"
@@ -0,0 +1,48 @@
+import importlib
+from utils.startup import timed
+
+
+class LazyHandler:
+    """
+    Handler callback given by its dotted path ("handlers.commands.help_handler").
+    The handler module is only imported when the first update is dispatched to it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.__name__ = path.rsplit(".", 1)[1]
+        self._func = None
+
+    def resolve(self):
+        if self._func is None:
+            module, name = self.path.rsplit(".", 1)
+            with timed(f"import:{self.path}"):
+                self._func = getattr(importlib.import_module(module), name)
+        return self._func
+
+    async def __call__(self, update, context):
+        return await self.resolve()(update, context)
+
+    def __repr__(self) -> str:
+        return f"LazyHandler({self.path!r})"
+
+
+# One LazyHandler per path, shared by every route that points to it
+_HANDLERS = {}
+
+
+def lazy(path: str) -> LazyHandler:
+    if path not in _HANDLERS:
+        _HANDLERS[path] = LazyHandler(path)
+    return _HANDLERS[path]
+
+
+# Modules holding the handlers routed by lambda_function
+HANDLER_MODULES = [
+    "handlers.commands",
+    "handlers.callbacks",
+    "handlers.admins",
+    "handlers.messages",
+    "handlers.payments",
+    "handlers.scheduled",
+]
@@ -0,0 +1,153 @@
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from telegram import MessageEntity, Update
+from telegram.ext import BaseHandler
+
+Route = Tuple[Callable, Optional[List[str]]]
+
+_REGEX_CHARS = set(".*+?{}[]\\|()^$")
+
+
+def parse_pattern(pattern: str) -> Tuple[str, bool]:
+    """
+    Literal text and whether it must match exactly, for the anchored patterns of
+    the routing tables: "^settings:Currency$" (exact) or "^settings:ai:" (prefix).
+    Patterns without "^" are treated like anchored ones, as re.match does.
+    """
+    text = pattern[1:] if pattern.startswith("^") else pattern
+    exact = text.endswith("$")
+    text = text[:-1] if exact else text
+    if not text or _REGEX_CHARS & set(text):
+        raise ValueError(f"Unsupported route pattern: {pattern!r}")
+    return text, exact
+
+
+class _Node:
+    __slots__ = ("children", "exact", "rest", "partial")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.exact: Optional[Callable] = None  # data ends at this node
+        self.rest: Optional[Callable] = None  # data continues after "<node>:"
+        self.partial: List[Tuple[str, Callable]] = []  # next segment starts with...
+
+
+class CallbackTrie:
+    """
+    callback_data routes split on ":". A lookup walks one node per segment of the
+    data, so its cost does not depend on the number of routes. The most specific
+    route wins.
+    """
+
+    def __init__(self):
+        self.root = _Node()
+
+    def add(self, pattern: str, handler: Callable) -> None:
+        text, exact = parse_pattern(pattern)
+        *parents, last = text.split(":")
+        node = self.root
+        for part in parents:
+            node = node.children.setdefault(part, _Node())
+        if exact:
+            node = node.children.setdefault(last, _Node())
+            node.exact = handler
+        elif last == "":
+            node.rest = handler
+        else:
+            node.partial.append((last, handler))
+
+    def lookup(self, data: str) -> Optional[Callable]:
+        node = self.root
+        found = None
+        for part in data.split(":"):
+            if node.rest:
+                found = node.rest
+            for prefix, handler in node.partial:
+                if part.startswith(prefix):
+                    found = handler
+            node = node.children.get(part)
+            if node is None:
+                return found
+        return node.exact or found
+
+
+class UpdateRouter(BaseHandler):
+    """
+    One handler for callback queries, commands, menu buttons and free text, in place
+    of a CallbackQueryHandler/CommandHandler/MessageHandler per route that the
+    Application would test one after another. Built from the routing tables:
+
+        callbacks  {"^settings:Currency$": handler, "^history:window:": handler}
+        menu       {"^❓ Help$": handler}
+        commands   {"help": handler}
+        text       free text that is not a command
+        unknown_command
+
+    Updates without a route (payments...) are left to the next handlers of the group.
+    """
+
+    def __init__(
+        self,
+        callbacks: Dict[str, Callable],
+        menu: Iterable[Tuple[str, Callable]],
+        commands: Iterable[Tuple[str, Callable]],
+        text: Callable = None,
+        unknown_command: Callable = None,
+        block: bool = True,
+    ):
+        super().__init__(self.dispatch, block=block)
+        self.callbacks = CallbackTrie()
+        for pattern, handler in callbacks.items():
+            self.callbacks.add(pattern, handler)
+        self.menu = {}
+        for pattern, handler in menu:
+            label, exact = parse_pattern(pattern)
+            if not exact:
+                raise ValueError(f"Menu patterns must match the whole text: {pattern!r}")
+            self.menu[label] = handler
+        self.commands = {cmd.lower(): handler for cmd, handler in commands}
+        self.text = text
+        self.unknown_command = unknown_command
+        self.bot_username: Optional[str] = None
+
+    def _command(self, message) -> Optional[Route]:
+        command, _, username = message.text[1 : message.entities[0].length].partition("@")
+        if username and username.lower() != (self.bot_username or "").lower():
+            # Addressed to another bot in a group
+            return (self.unknown_command, None) if self.unknown_command else None
+        handler = self.commands.get(command.lower(), self.unknown_command)
+        return (handler, message.text.split()[1:]) if handler else None
+
+    def check_update(self, update: object) -> Optional[Route]:
+        if not isinstance(update, Update):
+            return None
+        if update.callback_query:
+            data = update.callback_query.data
+            handler = self.callbacks.lookup(data) if isinstance(data, str) else None
+            return (handler, None) if handler else None
+        message = update.effective_message
+        if message is None or not message.text:
+            return None
+        if (
+            message.entities
+            and message.entities[0].type == MessageEntity.BOT_COMMAND
+            and message.entities[0].offset == 0
+        ):
+            if self.bot_username is None:
+                self.bot_username = message.get_bot().username
+            return self._command(message)
+        handler = self.menu.get(message.text, self.text)
+        return (handler, None) if handler else None
+
+    def collect_additional_context(self, context, update, application, check_result) -> None:
+        context.args = check_result[1]
+
+    async def handle_update(self, update, application, check_result, context):
+        self.collect_additional_context(context, update, application, check_result)
+        return await check_result[0](update, context)
+
+    async def dispatch(self, update, context):
+        """Route an update outside of the Application (same lookup as check_update)."""
+        route = self.check_update(update)
+        if route:
+            context.args = route[1]
+            return await route[0](update, context)
@@ -1,5 +1,4 @@
 import os
-from utils.general import single_msg
 
 ENVIRONMENT = os.getenv("MY_ENVIRONMENT")
 if ENVIRONMENT == "local":
@@ -7,40 +6,136 @@ if ENVIRONMENT == "local":
 
     load_dotenv(override=True)
 
-single_msg("Starting...", os.getenv("BOT_TOKEN"), os.getenv("MY_CHAT_ID"))
-
 import asyncio
 import json
+from utils.startup import Lazy, timed, startup_report
 
-from telegram.ext import (
-    ApplicationBuilder,
-    CommandHandler,
-    MessageHandler,
-    CallbackQueryHandler,
-    PreCheckoutQueryHandler,
-    filters,
-)
-from telegram import Update
-from handlers import (
-    commands as cm_hdl,
-    callbacks as cb_hdl,
-    admins as ad_hdl,
-    messages as msg_hdl,
-    payments as pm_hdl,
-    scheduled as sch_hdl,
+with timed("import:telegram"):
+    from telegram.ext import (
+        ApplicationBuilder,
+        MessageHandler,
+        PreCheckoutQueryHandler,
+        filters,
+    )
+    from telegram import Update
+# Handler modules are imported on first dispatch, see handlers.registry
+from handlers.registry import lazy
+from handlers.router import UpdateRouter
+from utils.async_db import AsyncExpenseDB
+from utils.dedup import UpdateDeduplicator
+from utils.http import close_sync_client, telegram_request
+from utils.ingest import (
+    SqsQueue,
+    UpdateFailed,
+    collect_handler_errors,
+    process_batch,
+    record_handler_error,
 )
-from utils.db import ExpenseDB
-from utils.llm import AIClient
+from utils.inline_reply import InlineReplyRequest, capture_first_call
+from utils.metrics import track_update
+from utils.notifier import Notifier
+from utils.rate_limiter import LocalRateStore
+from utils.throttle import bulk_work
+from utils.update_processor import PerUserUpdateProcessor
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 MY_CHAT_ID = int(os.getenv("MY_CHAT_ID"))
 LLM_API_KEY = os.getenv("LLM_API_KEY")
 SPECIAL_PREFIX = os.getenv("SPECIAL_PREFIX")
 REQUESTS_PER_DAY = 100
+# Separate daily caps of the expensive operations (LLM calls, full-history scans)
+QUOTAS_PER_DAY = {"llm": 30, "scan": 5}
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "dynamodb")
+# "db": counters read/written with every update, "local": in memory, synced periodically
+# (for polling, a reclaimed Lambda container loses its unsynced counts),
+# "atomic": one conditional UpdateItem per update (safe across concurrent containers)
+RATE_LIMIT_MODE = os.getenv("RATE_LIMIT_MODE", "db")
+# "direct": each webhook is processed by its own invocation, "queue": webhooks are sent
+# to SQS_QUEUE_URL and processed in batches by the invocations of the SQS trigger
+INGEST_MODE = os.getenv("INGEST_MODE", "direct")
+SQS_QUEUE_URL = os.getenv("SQS_QUEUE_URL")
+if INGEST_MODE == "queue" and not SQS_QUEUE_URL:
+    # Nothing would ever consume the queued updates
+    raise RuntimeError("INGEST_MODE=queue requires SQS_QUEUE_URL")
+# Answer the first Bot API call of a webhook update in the HTTP response
+INLINE_REPLIES = os.getenv("INLINE_REPLIES", "0") == "1"
+# Updates handled at the same time when polling, those of a user always in order
+POLL_CONCURRENCY = int(os.getenv("POLL_CONCURRENCY", "16"))
+
+
+def build_storage():
+    if STORAGE_BACKEND == "sqlite":
+        from utils.db_sqlite import SQLiteExpenseDB
+
+        return SQLiteExpenseDB(path=os.getenv("SQLITE_PATH", "expenses.db"))
+    from utils.db import ExpenseDB
+
+    return ExpenseDB(region_name="eu-central-1")
+
+
+def build_llm():
+    from utils.llm import AIClient
+
+    return AIClient(api_key=LLM_API_KEY)
+
+
+def build_queue():
+    return SqsQueue(SQS_QUEUE_URL, region_name="eu-central-1")
+
 
-app = ApplicationBuilder().token(BOT_TOKEN).build()
-db = ExpenseDB(region_name="eu-central-1")
-llm = AIClient(api_key=LLM_API_KEY)
+async def on_shutdown(app):
+    store = app.bot_data.get("rate_store")
+    if store is not None:
+        await store.sync(db.get(), force=True)
+    await notifier.flush(app.bot, force=True)
+    close_sync_client()
+
+
+async def report_error(update, context):
+    """Errors raised by handlers, otherwise only logged by the Application."""
+    record_handler_error(context.error)
+    notifier.error("handler", context.error)
+    if ENVIRONMENT == "local":
+        # Lambda sends the digest at the end of the invocation
+        await notifier.flush(context.bot)
+
+
+with timed("init:application"):
+    # Pool sizes, timeouts and HTTP/2 come from utils.http, shared with the OpenAI client
+    bot_request = telegram_request()
+    if INLINE_REPLIES:
+        bot_request = InlineReplyRequest(bot_request)
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(bot_request)
+        # Long polling holds its connection open, keep it off the shared pool
+        .get_updates_request(telegram_request(pool_size=1, read_timeout=30))
+        .post_shutdown(on_shutdown)
+    )
+    if ENVIRONMENT == "local":
+        # Lambda calls process_update directly, only the polling loop uses the processor
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(POLL_CONCURRENCY))
+    app = builder.build()
+# Storage (boto3) and the LLM client (openai) are built on first use, see get_db/get_ai_client
+db = Lazy("init:storage", lambda: AsyncExpenseDB(build_storage()))
+llm = Lazy("init:llm", build_llm)
+rate_store = (
+    LocalRateStore(sync_interval=int(os.getenv("RATE_SYNC_SECONDS", "60")))
+    if RATE_LIMIT_MODE == "local"
+    else None
+)
+# Operator messages are queued and sent as one digest per invocation (per NOTIFY_INTERVAL
+# when polling), see main and report_error
+notifier = Notifier(MY_CHAT_ID, min_interval=float(os.getenv("NOTIFY_INTERVAL", "60")))
+notifier.notify("Starting...")
+# Redeliveries are dropped per container; DEDUP_PERSISTENT=1 also claims every update_id
+# in storage (one write per update) to drop them across containers
+dedup = UpdateDeduplicator(
+    bot_id=BOT_TOKEN.split(":")[0],
+    db=db if os.getenv("DEDUP_PERSISTENT", "0") == "1" else None,
+)
+queue = Lazy("init:queue", build_queue)
 
 app.bot_data.update(
     {
@@ -49,130 +144,199 @@ app.bot_data.update(
         "admins": {int(i) for i in os.getenv("ADMINS", "").split(",") if i.isdigit()},
         "owner": MY_CHAT_ID,
         "requests_per_day": REQUESTS_PER_DAY,
+        "quotas_per_day": QUOTAS_PER_DAY,
         "special_prefix": SPECIAL_PREFIX,
+        "rate_store": rate_store,
+        "rate_limit_mode": RATE_LIMIT_MODE,
     }
 )
 
 # Menu Messages
-for pattern, handler in [
-    ("^❓ Help$", cm_hdl.help_handler),
-    ("^⚙️ Settings$", cm_hdl.settings_handler),
-    ("^⭐ Premium$", cm_hdl.premium_handler),
-    ("^💹 Stats$", cm_hdl.stats_handler),
-    ("^📆 History$", cm_hdl.history_handler),
-    ("^🧠 Artificial Intelligence$", cb_hdl.settings_ai),
-]:
-    app.add_handler(MessageHandler(filters.Regex(pattern), handler))
-
-# General message for expenses
-app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, msg_hdl.text_messages))
+menu_messages = [
+    ("^❓ Help$", "handlers.commands.help_handler"),
+    ("^⚙️ Settings$", "handlers.commands.settings_handler"),
+    ("^⭐ Premium$", "handlers.commands.premium_handler"),
+    ("^💹 Stats$", "handlers.commands.stats_handler"),
+    ("^📆 History$", "handlers.commands.history_handler"),
+    ("^🧠 Artificial Intelligence$", "handlers.callbacks.settings_ai"),
+]
 
 # Commands
-for cmd, handler in [
-    ("start", cm_hdl.start_handler),
-    ("help", cm_hdl.help_handler),
-    ("settings", cm_hdl.settings_handler),
-    ("premium", cm_hdl.premium_handler),
-    ("stats", cm_hdl.stats_handler),
-    ("history", cm_hdl.history_handler),
-    ("last", cm_hdl.last_n_handler),
-    ("artificial_intelligence", cm_hdl.cmd_ai_handler),
+commands = [
+    ("start", "handlers.commands.start_handler"),
+    ("help", "handlers.commands.help_handler"),
+    ("settings", "handlers.commands.settings_handler"),
+    ("premium", "handlers.commands.premium_handler"),
+    ("stats", "handlers.commands.stats_handler"),
+    ("history", "handlers.commands.history_handler"),
+    ("last", "handlers.commands.last_n_handler"),
+    ("artificial_intelligence", "handlers.commands.cmd_ai_handler"),
     # Premium
-    ("categories", cm_hdl.categories_handler),
-    ("budget", cm_hdl.budget_handler),
-    ("export", cm_hdl.export_handler),
-    ("delete", cm_hdl.delete_handler),
+    ("categories", "handlers.commands.categories_handler"),
+    ("budget", "handlers.commands.budget_handler"),
+    ("export", "handlers.commands.export_handler"),
+    ("delete", "handlers.commands.delete_handler"),
     # Admin
-    ("empty_user_data", ad_hdl.empty_user_data),
-    ("usage", ad_hdl.usage),
-    ("broadcast", ad_hdl.broadcast),
-    ("admin", ad_hdl.admin_help),
-]:
-    app.add_handler(CommandHandler(cmd, handler))
-
+    ("empty_user_data", "handlers.admins.empty_user_data"),
+    ("usage", "handlers.admins.usage"),
+    ("broadcast", "handlers.admins.broadcast"),
+    ("admin", "handlers.admins.admin_help"),
+]
 
 callback_queries = {
     # Help
-    "^help_premium$": cb_hdl.help_premium,
+    "^help_premium$": "handlers.callbacks.help_premium",
     # Settings
-    "^settings:Currency$": cb_hdl.settings_currency,
-    "^settings:Language$": cb_hdl.settings_language,
-    "^settings:Timezone$": cb_hdl.settings_timezone,
-    "^settings:Timezone:pt2$": cb_hdl.settings_timezone,
-    "^settings:Timezone:reset$": cb_hdl.settings_timezone_reset,
-    "^settings:Timezone:id:": cb_hdl.settings_timezone_confirm,
-    "^settings:Categories$": cb_hdl.settings_categories,
-    "^settings:Notifications$": cb_hdl.settings_notify,
-    "^settings:cancel$": cb_hdl.settings_cancel,
-    "^settings:Artificial Intelligence$": cb_hdl.settings_ai,
+    "^settings:Currency$": "handlers.callbacks.settings_currency",
+    "^settings:Language$": "handlers.callbacks.settings_language",
+    "^settings:Timezone$": "handlers.callbacks.settings_timezone",
+    "^settings:Timezone:pt2$": "handlers.callbacks.settings_timezone",
+    "^settings:Timezone:reset$": "handlers.callbacks.settings_timezone_reset",
+    "^settings:Timezone:id:": "handlers.callbacks.settings_timezone_confirm",
+    "^settings:Categories$": "handlers.callbacks.settings_categories",
+    "^settings:Notifications$": "handlers.callbacks.settings_notify",
+    "^settings:cancel$": "handlers.callbacks.settings_cancel",
+    "^settings:Artificial Intelligence$": "handlers.callbacks.settings_ai",
     # AI
-    "^settings:ai:": cb_hdl.ai_change_status,
+    "^settings:ai:": "handlers.callbacks.ai_change_status",
     # History
-    "^history:cancel$": cb_hdl.history_cancel,
-    "^history:window:": cb_hdl.history_windows,
-    "^history:back_to_menu$": cb_hdl.history_back,
+    "^history:cancel$": "handlers.callbacks.history_cancel",
+    "^history:window:": "handlers.callbacks.history_windows",
+    "^history:back_to_menu$": "handlers.callbacks.history_back",
     # Stats
-    "^stats:cancel$": cb_hdl.stats_cancel,
-    "^stats:window:": cb_hdl.stats_windows,
-    "^stats:back_to_menu$": cb_hdl.stats_back,
+    "^stats:cancel$": "handlers.callbacks.stats_cancel",
+    "^stats:window:": "handlers.callbacks.stats_windows",
+    "^stats:back_to_menu$": "handlers.callbacks.stats_back",
     # Expenses (add, delete)
-    "^expenses:cancel$": cb_hdl.cancel_new_expense,
-    "^expenses:delete:cancel$": cb_hdl.cancel_expense_deletion,
-    "^expenses:category:": cb_hdl.expense_confirm_category,
-    "^expenses:delete:id:": cb_hdl.confirm_delete_expense,
+    "^expenses:cancel$": "handlers.callbacks.cancel_new_expense",
+    "^expenses:delete:cancel$": "handlers.callbacks.cancel_expense_deletion",
+    "^expenses:category:": "handlers.callbacks.expense_confirm_category",
+    "^expenses:delete:id:": "handlers.callbacks.confirm_delete_expense",
     # Categories
-    "^categories:menu:cancel$": cb_hdl.cancel_mgmt_categories,
-    "^categories:menu:add$": cb_hdl.add_category,
-    "^categories:menu:reset$": cb_hdl.reset_categories,
-    "^categories:menu:delete$": cb_hdl.delete_category,
-    "^categories:delete:back_to_menu$": cb_hdl.categories_back_to_menu,
-    "^categories:delete:list:": cb_hdl.confirm_delete_category,
+    "^categories:menu:cancel$": "handlers.callbacks.cancel_mgmt_categories",
+    "^categories:menu:add$": "handlers.callbacks.add_category",
+    "^categories:menu:reset$": "handlers.callbacks.reset_categories",
+    "^categories:menu:delete$": "handlers.callbacks.delete_category",
+    "^categories:delete:back_to_menu$": "handlers.callbacks.categories_back_to_menu",
+    "^categories:delete:list:": "handlers.callbacks.confirm_delete_category",
     # Premium
-    "^premium:cancel$": cb_hdl.cancel_select_plan,
-    "^premium:select_plan:": cb_hdl.confirm_premium_plan,
+    "^premium:cancel$": "handlers.callbacks.cancel_select_plan",
+    "^premium:select_plan:": "handlers.callbacks.confirm_premium_plan",
     # Unknown callback
-    "unknown": cb_hdl.unknown_callback,
+    "unknown": "handlers.callbacks.unknown_callback",
 }
 
-for pattern, handler in callback_queries.items():
-    app.add_handler(CallbackQueryHandler(handler, pattern))
+# Menu texts and callback_data are looked up in a dict/trie instead of testing one
+# handler per route, see handlers.router
+app.add_handler(
+    UpdateRouter(
+        callbacks={pattern: lazy(handler) for pattern, handler in callback_queries.items()},
+        menu=[(pattern, lazy(handler)) for pattern, handler in menu_messages],
+        commands=[(cmd, lazy(handler)) for cmd, handler in commands],
+        # General message for expenses
+        text=lazy("handlers.messages.text_messages"),
+        unknown_command=lazy("handlers.commands.unknown_command_handler"),
+    )
+)
 
 # Payments
-app.add_handler(PreCheckoutQueryHandler(pm_hdl.pre_checkout_handler))
-app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, pm_hdl.successful_payment_handler))
+app.add_handler(PreCheckoutQueryHandler(lazy("handlers.payments.pre_checkout_handler")))
+app.add_handler(
+    MessageHandler(filters.SUCCESSFUL_PAYMENT, lazy("handlers.payments.successful_payment_handler"))
+)
 
-app.add_handler(MessageHandler(filters.COMMAND, cm_hdl.unknown_command_handler))
+app.add_error_handler(report_error)
 
 is_initialized = None
 
 
+async def handle_update(body: dict) -> None:
+    # Telegram redelivers the webhook when a run is slow, process each update once
+    if await dedup.is_duplicate(body["update_id"]):
+        print(f"Skipping duplicate update {body['update_id']}")
+        return
+    try:
+        with collect_handler_errors() as errors:
+            await app.process_update(Update.de_json(body, app.bot))
+        if errors:
+            # Fails the SQS record (and the user's later ones) so that they are retried
+            raise UpdateFailed(f"Update {body['update_id']}: {errors[0]!r}") from errors[0]
+    except Exception:
+        # Let the retry of a failed update through
+        await dedup.release(body["update_id"])
+        raise
+
+
 async def main(event):
     global is_initialized
     scheduler = event.get("schedule", None)
+    if INGEST_MODE == "queue" and "body" in event:
+        # Webhook: only enqueue, the SQS trigger processes the update
+        queue.get().send(json.loads(event["body"]))
+        return {"statusCode": 200, "body": "Queued"}
+    response = {"statusCode": 200, "body": "Success"}
     try:
+        cold_start = not is_initialized
         if not is_initialized:
-            await app.initialize()
+            with timed("init:bot"):
+                await app.initialize()
             is_initialized = True
+        if scheduler in ("monthly", "daily"):
+            from handlers import scheduled as sch_hdl
         if scheduler == "monthly":
             print("Sending MONTHLY reminders...")
-            await sch_hdl.send_monthly_report(app.bot, db)
+            with track_update("send_monthly_report"), bulk_work():
+                await sch_hdl.send_monthly_report(app.bot, db.get())
         elif scheduler == "daily":
             print("Sending DAILY reminders...")
-            await sch_hdl.send_daily_reminder(app.bot, db)
+            with track_update("send_daily_reminder"), bulk_work():
+                await sch_hdl.send_daily_reminder(app.bot, db.get())
+        elif "Records" in event:
+            # SQS batch: init and connections are shared by every update of the batch
+            response = await process_batch(event["Records"], handle_update)
+            print(
+                json.dumps(
+                    {
+                        "batch_size": len(event["Records"]),
+                        "failed": len(response["batchItemFailures"]),
+                    }
+                )
+            )
+        elif INLINE_REPLIES:
+            with capture_first_call() as reply:
+                await handle_update(json.loads(event["body"]))
+            if reply.call:
+                response = reply.webhook_response()
         else:
-            update = Update.de_json(json.loads(event["body"]), app.bot)
-            await app.process_update(update)
+            await handle_update(json.loads(event["body"]))
+        if cold_start:
+            print(json.dumps({"startup_ms": startup_report()}))
     except Exception as e:
-        single_msg(f"ERROR in main: {str(e)}", BOT_TOKEN, MY_CHAT_ID)
-    return {"statusCode": 200, "body": "Success"}
+        if not isinstance(e, UpdateFailed):
+            # Handler errors were already reported by report_error
+            notifier.error("main", e)
+        if "Records" in event and "batchItemFailures" not in response:
+            # Failed before process_batch ran any update (init): none was processed, retry
+            # them all. Once it returned, its response only lists the unprocessed ones.
+            response = {
+                "batchItemFailures": [{"itemIdentifier": r["messageId"]} for r in event["Records"]]
+            }
+    if rate_store is not None:
+        # No shutdown hook in Lambda, don't leave due deltas for the next invocation
+        await rate_store.sync(db.get())
+    # One message per invocation at most, after the update has been answered
+    await notifier.flush(app.bot, force=True)
+    return response
 
 
 def lambda_handler(event, context):
+    loop = asyncio.get_event_loop()
     try:
-        asyncio.get_event_loop().run_until_complete(main(event))
-        return {"statusCode": 200, "body": "Success"}
+        # The SQS trigger reads the partial batch failures from the response
+        return loop.run_until_complete(main(event))
     except Exception as e:
-        single_msg(str(e))
+        notifier.error("lambda_handler", e)
+        loop.run_until_complete(notifier.flush(app.bot, force=True))
 
 
 if ENVIRONMENT == "local":
@@ -0,0 +1,80 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from typing import Any, AsyncIterator, Dict, List, Union
+from utils.storage import BaseExpenseDB
+from utils.user_record import UserRecord
+
+_EXHAUSTED = object()
+
+
+class AsyncExpenseDB:
+    """
+    Awaitable facade over a storage backend with the same methods. Blocking calls run
+    on a thread pool sized to the backend's max_pool_connections (botocore's pool for
+    DynamoDB), so a slow storage request never stalls the event loop for other users.
+    """
+
+    def __init__(self, db: BaseExpenseDB, max_workers: int = None):
+        self.sync = db
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers or db.max_pool_connections, thread_name_prefix="storage"
+        )
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        # Storage calls keep the caller's context (handler tag for metrics)
+        ctx = contextvars.copy_context()
+        return await loop.run_in_executor(self.executor, partial(ctx.run, func, *args, **kwargs))
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.sync, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        async def method(*args, **kwargs):
+            return await self.run(attr, *args, **kwargs)
+
+        return method
+
+    async def _iterate(self, iterator) -> AsyncIterator[Any]:
+        while True:
+            value = await self.run(next, iterator, _EXHAUSTED)
+            if value is _EXHAUSTED:
+                return
+            yield value
+
+    def iter_expenses(self, *args, **kwargs) -> AsyncIterator[List[Dict[str, Any]]]:
+        return self._iterate(self.sync.iter_expenses(*args, **kwargs))
+
+    def iter_rollups(self, *args, **kwargs) -> AsyncIterator[Dict[str, Any]]:
+        return self._iterate(self.sync.iter_rollups(*args, **kwargs))
+
+    # Reads and writes served by the per-update record need no thread hop
+
+    async def get_fields(
+        self,
+        user_id: str,
+        bot_id: str,
+        fields: Union[str, List[str]],
+        record: UserRecord = None,
+    ) -> Union[Any, Dict[str, Any], None]:
+        if record is not None:
+            return self.sync.get_fields(user_id, bot_id, fields, record=record)
+        return await self.run(self.sync.get_fields, user_id, bot_id, fields)
+
+    async def update_field(
+        self, user_id: str, bot_id: str, field: str, value: Any, record: UserRecord = None
+    ) -> None:
+        if record is not None:
+            return self.sync.update_field(user_id, bot_id, field, value, record=record)
+        return await self.run(self.sync.update_field, user_id, bot_id, field, value)
+
+    async def update_multiple_fields(
+        self, user_id: str, bot_id: str, updates: Dict[str, Any], record: UserRecord = None
+    ) -> None:
+        if record is not None:
+            return self.sync.update_multiple_fields(user_id, bot_id, updates, record=record)
+        return await self.run(self.sync.update_multiple_fields, user_id, bot_id, updates)
@@ -1,20 +1,153 @@
+import os
+import time
 import boto3
-from boto3.dynamodb.conditions import Key
-from datetime import datetime, date
-from decimal import Decimal
-from typing import List, Dict, Any, Union
-from uuid import uuid4
-from utils.dates import parse_timezone, get_str_timestamp
-
-
-class ExpenseDB:
-    def __init__(self, region_name: str):
-        self.dynamodb = boto3.resource("dynamodb", region_name=region_name)
+from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import ClientError, ReadTimeoutError
+from botocore.exceptions import ConnectionError as BotoConnectionError
+from datetime import date
+from typing import List, Dict, Any, Union, Optional, Iterator, Tuple
+from utils.storage import BaseExpenseDB, ConditionFailed, ROLLUPS_READY, fmt_date
+from utils.metrics import capacity_units, record_request
+from utils.throttle import (
+    RETRYABLE_ERRORS,
+    TRANSIENT_CANCELLATIONS,
+    ThroughputGovernor,
+    backoff_delay,
+    is_bulk,
+    parse_capacity,
+)
+
+
+def projection(fields: Optional[List[str]]) -> Dict[str, Any]:
+    """
+    ProjectionExpression kwargs for the given attributes. Every name is aliased
+    since several of ours (date, timestamp) are DynamoDB reserved words.
+    """
+    if not fields:
+        return {}
+    names = {f"#p{i}": field for i, field in enumerate(fields)}
+    return {"ProjectionExpression": ", ".join(names), "ExpressionAttributeNames": names}
+
+
+class ExpenseDB(BaseExpenseDB):
+    """DynamoDB backend."""
+
+    def __init__(
+        self,
+        region_name: str,
+        max_pool_connections: int = 10,
+        capacity: Dict[str, tuple] = None,
+        max_attempts: int = 8,
+    ):
+        """
+        capacity: (RCU, WCU) by table or "Table/Index" that bulk work is paced to.
+        Defaults to DYNAMODB_CAPACITY: unset (no pacing, throttled requests are only
+        retried), "describe" (the provisioned capacity read with DescribeTable) or
+        "Expenses=5:5,Users=2:2,...".
+        """
+        self.max_pool_connections = max_pool_connections
+        self.max_attempts = max_attempts
+        self.dynamodb = boto3.resource(
+            "dynamodb",
+            region_name=region_name,
+            # Retries are done by _request, paced by the governor
+            config=Config(
+                max_pool_connections=max_pool_connections, retries={"total_max_attempts": 1}
+            ),
+        )
         self.table_name = "Expenses"
         self.users_table_name = "Users"
+        self.rollup_table_name = "ExpensesRollup"
+        self.updates_table_name = "ProcessedUpdates"
         self.table = self.dynamodb.Table(self.table_name)
         self.users_table = self.dynamodb.Table(self.users_table_name)
+        self.rollup_table = self.dynamodb.Table(self.rollup_table_name)
+        self.updates_table = self.dynamodb.Table(self.updates_table_name)
         self.region_name = region_name
+        if capacity is None:
+            spec = os.getenv("DYNAMODB_CAPACITY", "")
+            capacity = self.provisioned_capacity() if spec == "describe" else parse_capacity(spec)
+        self.governor = ThroughputGovernor(capacity)
+
+    def provisioned_capacity(self) -> Dict[str, tuple]:
+        """(RCU, WCU) of our tables and their indexes. On-demand tables are left out."""
+        capacity = {}
+        client = self.dynamodb.meta.client
+        for table_name in (
+            self.table_name,
+            self.users_table_name,
+            self.rollup_table_name,
+            self.updates_table_name,
+        ):
+            table = client.describe_table(TableName=table_name)["Table"]
+            parts = [(table_name, table)] + [
+                (f"{table_name}/{index['IndexName']}", index)
+                for index in table.get("GlobalSecondaryIndexes", [])
+            ]
+            for name, part in parts:
+                units = part.get("ProvisionedThroughput", {})
+                if units.get("ReadCapacityUnits") or units.get("WriteCapacityUnits"):
+                    capacity[name] = (units["ReadCapacityUnits"], units["WriteCapacityUnits"])
+        return capacity
+
+    def _request(
+        self, call, table_name: str, kind: str, index: str = None, **kwargs
+    ) -> Dict[str, Any]:
+        """
+        Every DynamoDB call goes through here. Bulk work (see bulk_work) waits until
+        the table (or index) has capacity left. Every call pays the ConsumedCapacity
+        of its response back to the governor, and throttled or failed requests are
+        retried with jittered backoff. Capacity and wall time are accounted to the
+        running handler.
+        """
+        for attempt in range(self.max_attempts):
+            if is_bulk():
+                self.governor.wait(table_name, kind, index)
+            start = time.perf_counter()
+            try:
+                response = call(ReturnConsumedCapacity="INDEXES", **kwargs)
+            except ClientError as e:
+                record_request(0, 0, time.perf_counter() - start)
+                if e.response["Error"]["Code"] not in RETRYABLE_ERRORS:
+                    raise
+                if attempt == self.max_attempts - 1:
+                    raise
+                self.governor.throttled(table_name, kind, index)
+            except (BotoConnectionError, ReadTimeoutError):
+                record_request(0, 0, time.perf_counter() - start)
+                if attempt == self.max_attempts - 1:
+                    raise
+            else:
+                consumed = response.get("ConsumedCapacity")
+                record_request(*capacity_units(consumed, kind), time.perf_counter() - start)
+                self.governor.record(consumed)
+                return response
+            time.sleep(backoff_delay(attempt))
+
+    def _batch_write(self, table_name: str, requests: List[Dict[str, Any]]) -> None:
+        """BatchWriteItem in chunks of 25, retrying UnprocessedItems."""
+        for i in range(0, len(requests), 25):
+            request = {table_name: requests[i : i + 25]}
+            for attempt in range(self.max_attempts):
+                response = self._request(
+                    self.dynamodb.batch_write_item, table_name, "write", RequestItems=request
+                )
+                request = response.get("UnprocessedItems")
+                if not request:
+                    break
+                # Unprocessed items mean the table is over its capacity
+                self.governor.throttled(table_name, "write")
+                time.sleep(backoff_delay(attempt))
+            else:
+                raise RuntimeError(f"Unprocessed items left after {self.max_attempts} attempts")
+
+    def create_tables(self) -> None:
+        self.create_table()
+        self.create_users_table()
+        self.create_rollup_table()
+        self.create_updates_table()
 
     def create_table(self) -> None:
         existing_tables = boto3.client("dynamodb", region_name=self.region_name).list_tables()[
@@ -51,120 +184,162 @@ class ExpenseDB:
         self.table.wait_until_exists()
         print(f"Table '{self.table_name}' created.")
 
-    def get_fields(
-        self, user_id: str, bot_id: str, fields: Union[str, List[str]]
-    ) -> Union[Any, Dict[str, Any], None]:
-        if isinstance(fields, str):
-            fields = [fields]
+    def get_user(self, user_id: str, bot_id: str) -> Optional[Dict[str, Any]]:
+        """Fetch the full Users item, or None if the user is not registered."""
+        response = self._request(
+            self.users_table.get_item,
+            self.users_table_name,
+            "read",
+            Key={"user_id": str(user_id), "bot_id": str(bot_id)},
+        )
+        return response.get("Item")
 
-        projection = ", ".join(fields)
+    def put_user(self, item: Dict[str, Any]) -> None:
+        self._request(self.users_table.put_item, self.users_table_name, "write", Item=item)
 
-        response = self.users_table.get_item(
-            Key={"user_id": str(user_id), "bot_id": str(bot_id)}, ProjectionExpression=projection
+    def delete_user(self, user_id: str, bot_id: str) -> None:
+        self._request(
+            self.users_table.delete_item,
+            self.users_table_name,
+            "write",
+            Key={"user_id": str(user_id), "bot_id": str(bot_id)},
         )
-        item = response.get("Item", {})
 
-        if len(fields) == 1:
-            return item.get(fields[0])
-        return item
+    def _get_user_fields(self, user_id: str, bot_id: str, fields: List[str]) -> Dict[str, Any]:
+        projection = ", ".join(fields)
 
-    def insert_expense(
-        self,
-        user_id: str,
-        amount: float,
-        category: str,
-        currency: str,
-        description: str = "",
-        income: bool = False,
-        timezone: str = "UTC-6",
-    ) -> None:
-        # Parse the timezone string (e.g., "UTC-6" or "UTC+3")
-        tz = parse_timezone(timezone)
-        current_time = datetime.now(tz)
-        uid = str(uuid4())[:7]
-        timestamp = str(int(current_time.timestamp()))
-        date_str = current_time.strftime("%Y-%m-%d")
-
-        item = {
-            "user_id": user_id,
-            "timestamp": f"{timestamp}_{uid}",
-            "date": date_str,
-            "amount": Decimal(str(amount)),
-            "category": category,
-            "currency": currency,
-            "description": description,
-            "income": income,
-        }
-        self.table.put_item(Item=item)
+        response = self._request(
+            self.users_table.get_item,
+            self.users_table_name,
+            "read",
+            Key={"user_id": str(user_id), "bot_id": str(bot_id)},
+            ProjectionExpression=projection,
+        )
+        return response.get("Item", {})
 
-    def fetch_expenses_by_user_and_date(
+    def _transact(self, actions: List[Dict[str, Any]]) -> None:
+        """
+        TransactWriteItems, retried while it is only cancelled by conflicts with other
+        writes of the same items (concurrent ADDs to a rollup) or throttling.
+        """
+        for attempt in range(self.max_attempts):
+            try:
+                self._request(
+                    self.dynamodb.meta.client.transact_write_items,
+                    self.table_name,
+                    "write",
+                    TransactItems=actions,
+                )
+                return
+            except self.dynamodb.meta.client.exceptions.TransactionCanceledException as e:
+                codes = {r.get("Code") for r in e.response.get("CancellationReasons", [])}
+                if not codes - {"None"} <= TRANSIENT_CANCELLATIONS:
+                    raise
+                if attempt == self.max_attempts - 1:
+                    raise
+            time.sleep(backoff_delay(attempt))
+
+    def _put_expense(self, item: Dict[str, Any]) -> None:
+        serialize = TypeSerializer().serialize
+        self._transact(
+            [
+                {
+                    "Put": {
+                        "TableName": self.table_name,
+                        "Item": {k: serialize(v) for k, v in item.items()},
+                    }
+                },
+                *self._rollup_actions([item]),
+            ]
+        )
+
+    def iter_expenses(
         self,
         user_id: str,
         start_date: Union[str, date],
         end_date: Union[str, date],
-        ascending: bool = True,
-    ) -> List[Dict[str, Any]]:
-        # Ensure dates are in YYYY-MM-DD format
-        if isinstance(start_date, date):
-            start_date = start_date.strftime("%Y-%m-%d")
-        if isinstance(end_date, date):
-            end_date = end_date.strftime("%Y-%m-%d")
-
-        response = self.table.query(
-            IndexName="UserDateIndex",
-            KeyConditionExpression=Key("user_id").eq(user_id)
-            & Key("date").between(start_date, end_date),
+        page_size: int = 500,
+        fields: List[str] = None,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        # Follows LastEvaluatedKey, one query per page
+        query_kwargs = {
+            "IndexName": "UserDateIndex",
+            "KeyConditionExpression": Key("user_id").eq(user_id)
+            & Key("date").between(fmt_date(start_date), fmt_date(end_date)),
+            "Limit": page_size,
+            **projection(fields),
+        }
+        while True:
+            response = self._request(
+                self.table.query, self.table_name, "read", "UserDateIndex", **query_kwargs
+            )
+            items = response.get("Items", [])
+            if items:
+                yield items
+            last_key = response.get("LastEvaluatedKey")
+            if not last_key:
+                break
+            query_kwargs["ExclusiveStartKey"] = last_key
+
+    def get_expense(self, user_id: str, timestamp: str) -> Optional[Dict[str, Any]]:
+        response = self._request(
+            self.table.get_item,
+            self.table_name,
+            "read",
+            Key={"user_id": str(user_id), "timestamp": timestamp},
         )
-        items = response.get("Items", [])
-
-        # Sort items by timestamp
-        items.sort(key=lambda x: x["timestamp"], reverse=not ascending)
-
-        return items
+        return response.get("Item")
 
     def fetch_latest_expenses(
-        self, user_id: str, limit: int = 50, ascending=False
+        self, user_id: str, limit: int = 50, ascending=False, fields: List[str] = None
     ) -> List[Dict[str, Any]]:
-        """Fetch the most recent expenses for a user."""
-        response = self.table.query(
+        response = self._request(
+            self.table.query,
+            self.table_name,
+            "read",
             KeyConditionExpression=Key("user_id").eq(user_id),
             ScanIndexForward=ascending,  # Sort in descending order
             Limit=limit,
+            **projection(fields),
         )
         return list(reversed(response.get("Items", [])))
 
-    def remove_expense(self, user_id: str, timestamp: str) -> bool:
-        """
-        Remove an expense record by user_id and timestamp.
-        """
+    def remove_expense(self, user_id: str, timestamp: str) -> Optional[Dict[str, Any]]:
+        # The rollup decrements need the item, a transaction can't return it
+        item = self._request(
+            self.table.get_item,
+            self.table_name,
+            "read",
+            Key={"user_id": str(user_id), "timestamp": timestamp},
+            ConsistentRead=True,
+        ).get("Item")
+        if item is None:
+            return None
+        serialize = TypeSerializer().serialize
         try:
-            self.table.delete_item(Key={"user_id": user_id, "timestamp": timestamp})
-            return True
-        except Exception as e:
-            print(f"Error deleting item: {e}")
-            return False
-
-    def summarize_by_category(self, expenses: List[Dict[str, Any]]) -> Dict[str, float]:
-        summary = {}
-        for item in expenses:
-            category = item.get("category", "uncategorized")
-            amount = float(item.get("amount", 0))
-            if not item.get("income", False):
-                summary[category] = summary.get(category, 0) + amount
-            else:
-                # Track income separately with a special category
-                summary["💰 Income"] = summary.get("💰 Income", 0) + amount
-        return summary
-
-    def delete_last_record(self, user_id: str) -> bool:
-        latest = self.fetch_latest_expenses(user_id, limit=1)
-        if not latest:
-            return False
-        last_record = latest[0]
-        self.table.delete_item(
-            Key={"user_id": last_record["user_id"], "timestamp": last_record["timestamp"]}
-        )
-        return True
+            self._transact(
+                [
+                    {
+                        "Delete": {
+                            "TableName": self.table_name,
+                            "Key": {
+                                "user_id": serialize(item["user_id"]),
+                                "timestamp": serialize(timestamp),
+                            },
+                            "ConditionExpression": "attribute_exists(#ts)",
+                            "ExpressionAttributeNames": {"#ts": "timestamp"},
+                        }
+                    },
+                    *self._rollup_actions([item], sign=-1),
+                ]
+            )
+        except self.dynamodb.meta.client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get("CancellationReasons") or [{}]
+            # Deleted since it was read
+            if reasons[0].get("Code") == "ConditionalCheckFailed":
+                return None
+            raise
+        return item
 
     def delete_table(self) -> bool:
         """Delete the DynamoDB table if it exists."""
@@ -179,22 +354,38 @@ class ExpenseDB:
 
     def remove_batch_records(self, records: dict) -> bool:
         """
-        Remove batch records
+        Remove batch records. BatchWriteItem is not transactional, the users'
+        rollups are rebuilt afterwards (and on the next stats request if this fails).
         """
         items = records
+        users = {i["user_id"] for i in items}
+        for user_id in users:
+            self._invalidate_rollups(user_id)
         # Delete each record
-        with self.table.batch_writer() as batch:
-            for item in items:
-                batch.delete_item(Key={"user_id": item["user_id"], "timestamp": item["timestamp"]})
+        self._batch_write(
+            self.table_name,
+            [
+                {"DeleteRequest": {"Key": {"user_id": i["user_id"], "timestamp": i["timestamp"]}}}
+                for i in items
+            ],
+        )
+        for user_id in users:
+            self.rebuild_rollups(user_id)
+
+    def _delete_expense_keys(self, keys: List[Dict[str, str]]) -> None:
+        self._batch_write(self.table_name, [{"DeleteRequest": {"Key": key}} for key in keys])
 
     def insert_batch_records(self, records: list) -> bool:
         """
-        Insert batch records
+        Insert batch records, rebuilding the users' rollups like remove_batch_records
         """
         try:
-            with self.table.batch_writer() as batch:
-                for item in records:
-                    batch.put_item(Item=item)
+            users = {i["user_id"] for i in records}
+            for user_id in users:
+                self._invalidate_rollups(user_id)
+            self._batch_write(self.table_name, [{"PutRequest": {"Item": i}} for i in records])
+            for user_id in users:
+                self.rebuild_rollups(user_id)
             return True
         except Exception as e:
             # Log or handle the error properly
@@ -239,52 +430,387 @@ class ExpenseDB:
         table.wait_until_exists()
         print(f"Table '{self.users_table_name}' created.")
 
-    def add_activity(self, user_id: str, bot_id: str) -> None:
-        self.users_table.update_item(
-            Key={"user_id": user_id, "bot_id": bot_id},
-            UpdateExpression="SET total_requests = if_not_exists(total_requests, :start) + :inc, last_active = :now",
-            ExpressionAttributeValues={
-                ":inc": 1,
-                ":start": 0,
-                ":now": get_str_timestamp(),
-            },
+    def get_fields_by_bot(self, bot_id: str, fields=["user_id"]) -> List[Dict[str, Any]]:
+        """Fields of every user of the bot, following the index pages to the end."""
+        query_kwargs = {
+            "IndexName": "bot_id-index",
+            "KeyConditionExpression": Key("bot_id").eq(str(bot_id)),
+            "ProjectionExpression": ", ".join(fields),
+        }
+        items = []
+        while True:
+            response = self._request(
+                self.users_table.query,
+                self.users_table_name,
+                "read",
+                "bot_id-index",
+                **query_kwargs,
+            )
+            items.extend(response.get("Items", []))
+            last_key = response.get("LastEvaluatedKey")
+            if not last_key:
+                return items
+            query_kwargs["ExclusiveStartKey"] = last_key
+
+    def get_users_bulk(
+        self, user_ids: List[str], bot_id: str, fields: List[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        """
+        Fetch the given fields for many users with BatchGetItem (100 keys per call),
+        retrying UnprocessedKeys with jittered exponential backoff. Keyed by user_id.
+        """
+        attr_names = {f"#f{i}": f for i, f in enumerate(dict.fromkeys(["user_id", *fields]))}
+        users = {}
+        for i in range(0, len(user_ids), 100):
+            request = {
+                self.users_table_name: {
+                    "Keys": [
+                        {"user_id": str(uid), "bot_id": str(bot_id)}
+                        for uid in user_ids[i : i + 100]
+                    ],
+                    "ProjectionExpression": ", ".join(attr_names),
+                    "ExpressionAttributeNames": attr_names,
+                }
+            }
+            for attempt in range(self.max_attempts):
+                response = self._request(
+                    self.dynamodb.batch_get_item,
+                    self.users_table_name,
+                    "read",
+                    RequestItems=request,
+                )
+                for item in response.get("Responses", {}).get(self.users_table_name, []):
+                    users[item["user_id"]] = item
+                request = response.get("UnprocessedKeys")
+                if not request:
+                    break
+                self.governor.throttled(self.users_table_name, "read")
+                time.sleep(backoff_delay(attempt))
+            else:
+                raise RuntimeError(f"Unprocessed keys left after {self.max_attempts} attempts")
+        return users
+
+    def get_users_with_reminders(self, bot_id: str) -> List[str]:
+        """Ids of the bot's users that have daily reminders enabled."""
+        query_kwargs = {
+            "IndexName": "bot_id-index",
+            "KeyConditionExpression": Key("bot_id").eq(str(bot_id)),
+            "ProjectionExpression": "user_id, daily_reminders",
+            "FilterExpression": Attr("daily_reminders").eq(True),
+        }
+        users = []
+        while True:
+            response = self._request(
+                self.users_table.query,
+                self.users_table_name,
+                "read",
+                "bot_id-index",
+                **query_kwargs,
+            )
+            users.extend(item["user_id"] for item in response.get("Items", []))
+            last_key = response.get("LastEvaluatedKey")
+            if not last_key:
+                return users
+            query_kwargs["ExclusiveStartKey"] = last_key
+
+    def _update_user(
+        self,
+        user_id: str,
+        bot_id: str,
+        set_values: Dict[str, Any],
+        add_values: Dict[str, Union[int, float]] = None,
+    ) -> Dict[str, Any]:
+        expr_attr_names = {}
+        expr_attr_values = {}
+        set_parts = []
+        add_parts = []
+        for i, (key, val) in enumerate(set_values.items()):
+            expr_attr_names[f"#s{i}"] = key
+            expr_attr_values[f":s{i}"] = val
+            set_parts.append(f"#s{i} = :s{i}")
+        for i, (key, val) in enumerate((add_values or {}).items()):
+            expr_attr_names[f"#a{i}"] = key
+            expr_attr_values[f":a{i}"] = val
+            add_parts.append(f"#a{i} :a{i}")
+
+        update_expression = " ".join(
+            f"{action} " + ", ".join(parts)
+            for action, parts in (("SET", set_parts), ("ADD", add_parts))
+            if parts
         )
+        response = self._request(
+            self.users_table.update_item,
+            self.users_table_name,
+            "write",
+            Key={"user_id": str(user_id), "bot_id": str(bot_id)},
+            UpdateExpression=update_expression,
+            ExpressionAttributeNames=expr_attr_names,
+            ExpressionAttributeValues=expr_attr_values,
+            ReturnValues="UPDATED_NEW",
+        )
+        return response.get("Attributes", {})
+
+    def count_request(
+        self, user_id: str, bot_id: str, day: str, cap: int, timestamp: str, cost: int = 1
+    ) -> Tuple[bool, int]:
+        key = {"user_id": str(user_id), "bot_id": str(bot_id)}
+        names = {
+            "#day": "rl_day",
+            "#daily": "daily_requests",
+            "#last": "last_active",
+            "#total": "total_requests",
+        }
+        # Common case: same day and under the cap
+        try:
+            response = self._request(
+                self.users_table.update_item,
+                self.users_table_name,
+                "write",
+                Key=key,
+                UpdateExpression="SET #daily = #daily + :cost, #last = :now ADD #total :one",
+                ConditionExpression="#day = :day AND #daily < :cap",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={
+                    ":day": day,
+                    ":one": 1,
+                    ":cost": cost,
+                    ":cap": cap,
+                    ":now": timestamp,
+                },
+                ReturnValues="UPDATED_NEW",
+                ReturnValuesOnConditionCheckFailure="ALL_OLD",
+            )
+            return True, int(response["Attributes"]["daily_requests"])
+        except self.dynamodb.meta.client.exceptions.ConditionalCheckFailedException as e:
+            deserializer = TypeDeserializer()
+            old = {k: deserializer.deserialize(v) for k, v in e.response.get("Item", {}).items()}
+        if old.get("rl_day") == day:
+            return False, int(old.get("daily_requests", 0))
+
+        # First request of the user's day: start a new bucket
+        try:
+            self._request(
+                self.users_table.update_item,
+                self.users_table_name,
+                "write",
+                Key=key,
+                UpdateExpression="SET #day = :day, #daily = :cost, #last = :now ADD #total :one",
+                ConditionExpression="attribute_not_exists(#day) OR #day <> :day",
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues={
+                    ":day": day,
+                    ":one": 1,
+                    ":cost": cost,
+                    ":now": timestamp,
+                },
+            )
+            return True, cost
+        except self.dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            # Another container started the bucket first
+            return self.count_request(user_id, bot_id, day, cap, timestamp, cost)
+
+    def _set_categories_active(self, user_id: str, bot_id: str, states: Dict[str, int]) -> None:
+        names = {"#cats": "categories", "#active": "active"}
+        values = {}
+        set_parts, conditions = [], []
+        for i, (cat_id, active) in enumerate(states.items()):
+            names[f"#c{i}"] = cat_id
+            values[f":v{i}"] = active
+            set_parts.append(f"#cats.#c{i}.#active = :v{i}")
+            conditions.append(f"attribute_exists(#cats.#c{i})")
+        try:
+            self._request(
+                self.users_table.update_item,
+                self.users_table_name,
+                "write",
+                Key={"user_id": str(user_id), "bot_id": str(bot_id)},
+                UpdateExpression="SET " + ", ".join(set_parts),
+                ConditionExpression=" AND ".join(conditions),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values,
+            )
+        except self.dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            raise ConditionFailed(f"Unknown categories: {list(states)}")
+
+    def _put_category(
+        self, user_id: str, bot_id: str, cat_id: str, category: Dict[str, Any], seen_count: int
+    ) -> None:
+        try:
+            self._request(
+                self.users_table.update_item,
+                self.users_table_name,
+                "write",
+                Key={"user_id": str(user_id), "bot_id": str(bot_id)},
+                UpdateExpression="SET #cats.#new = :cat",
+                ConditionExpression="attribute_not_exists(#cats.#new) AND size(#cats) = :seen",
+                ExpressionAttributeNames={"#cats": "categories", "#new": cat_id},
+                ExpressionAttributeValues={":cat": category, ":seen": seen_count},
+            )
+        except self.dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            raise ConditionFailed("Categories changed since they were read")
+
+    # ##############################################################
+    # Rollups: per user totals by day ("D#YYYY-MM-DD") and month ("M#YYYY-MM")
+    # ##############################################################
+
+    def create_rollup_table(self) -> None:
+        client = boto3.client("dynamodb", region_name=self.region_name)
 
-    def get_fields_by_bot(self, bot_id: str, fields=["user_id"]) -> List[Dict[str, Any]]:
-        response = self.users_table.query(
-            IndexName="bot_id-index",
-            KeyConditionExpression=Key("bot_id").eq(str(bot_id)),
-            ProjectionExpression=", ".join(fields),
+        existing_tables = client.list_tables()["TableNames"]
+        if self.rollup_table_name in existing_tables:
+            print(f"Table '{self.rollup_table_name}' already exists.")
+            return
+
+        self.rollup_table = self.dynamodb.create_table(
+            TableName=self.rollup_table_name,
+            KeySchema=[
+                {"AttributeName": "user_id", "KeyType": "HASH"},
+                {"AttributeName": "period", "KeyType": "RANGE"},
+            ],
+            AttributeDefinitions=[
+                {"AttributeName": "user_id", "AttributeType": "S"},
+                {"AttributeName": "period", "AttributeType": "S"},
+            ],
+            ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
         )
-        items = response.get("Items", {})
-        return items
+        self.rollup_table.wait_until_exists()
+        print(f"Table '{self.rollup_table_name}' created.")
+
+    def _rollup_actions(self, records: List[Dict[str, Any]], sign: int = 1) -> List[Dict]:
+        """TransactWriteItems actions adding the records to their rollups, one ADD per item."""
+        serialize = TypeSerializer().serialize
+        actions = []
+        for (user_id, period), counters in self._rollup_deltas(records, sign).items():
+            names = {f"#c{i}": name for i, name in enumerate(counters)}
+            values = {f":c{i}": serialize(value) for i, value in enumerate(counters.values())}
+            actions.append(
+                {
+                    "Update": {
+                        "TableName": self.rollup_table_name,
+                        "Key": {"user_id": serialize(user_id), "period": serialize(period)},
+                        "UpdateExpression": "ADD "
+                        + ", ".join(f"#c{i} :c{i}" for i in range(len(names))),
+                        "ExpressionAttributeNames": names,
+                        "ExpressionAttributeValues": values,
+                    }
+                }
+            )
+        return actions
 
-    def update_field(self, user_id: str, bot_id: str, field: str, value: Any) -> None:
-        self.users_table.update_item(
-            Key={"user_id": str(user_id), "bot_id": str(bot_id)},
-            UpdateExpression="SET #f = :val",
-            ExpressionAttributeNames={"#f": field},
-            ExpressionAttributeValues={":val": value},
+    def iter_rollups(
+        self,
+        user_id: str,
+        granularity: str,
+        start_date: Union[str, date],
+        end_date: Union[str, date],
+    ) -> Iterator[Dict[str, Any]]:
+        start_date, end_date = fmt_date(start_date), fmt_date(end_date)
+        if granularity == "M":
+            start_date, end_date = start_date[:7], end_date[:7]
+
+        query_kwargs = {
+            "KeyConditionExpression": Key("user_id").eq(user_id)
+            & Key("period").between(f"{granularity}#{start_date}", f"{granularity}#{end_date}")
+        }
+        while True:
+            response = self._request(
+                self.rollup_table.query, self.rollup_table_name, "read", **query_kwargs
+            )
+            yield from response.get("Items", [])
+            last_key = response.get("LastEvaluatedKey")
+            if not last_key:
+                break
+            query_kwargs["ExclusiveStartKey"] = last_key
+
+    def _replace_rollups(self, user_id: str, deltas: Dict[tuple, dict]) -> None:
+        self._batch_write(
+            self.rollup_table_name,
+            [
+                {"DeleteRequest": {"Key": {"user_id": user_id, "period": item["period"]}}}
+                for granularity in ("D", "M")
+                for item in self.iter_rollups(user_id, granularity, "0000-00-00", "9999-99-99")
+            ],
+        )
+        self._batch_write(
+            self.rollup_table_name,
+            [
+                {"PutRequest": {"Item": {"user_id": uid, "period": period, **counters}}}
+                for (uid, period), counters in deltas.items()
+            ],
+        )
+        # Written last: until then ensure_rollups rebuilds them again
+        self._request(
+            self.rollup_table.put_item,
+            self.rollup_table_name,
+            "write",
+            Item={"user_id": user_id, "period": ROLLUPS_READY},
         )
 
-    def update_multiple_fields(self, user_id: str, bot_id: str, updates: dict[str, Any]) -> None:
-        update_expr_parts = []
-        expr_attr_names = {}
-        expr_attr_values = {}
+    def _invalidate_rollups(self, user_id: str) -> None:
+        self._request(
+            self.rollup_table.delete_item,
+            self.rollup_table_name,
+            "write",
+            Key={"user_id": user_id, "period": ROLLUPS_READY},
+        )
 
-        for i, (key, val) in enumerate(updates.items()):
-            placeholder_name = f"#f{i}"
-            placeholder_value = f":val{i}"
-            update_expr_parts.append(f"{placeholder_name} = {placeholder_value}")
-            expr_attr_names[placeholder_name] = key
-            expr_attr_values[placeholder_value] = val
+    def _rollups_ready(self, user_id: str) -> bool:
+        response = self._request(
+            self.rollup_table.get_item,
+            self.rollup_table_name,
+            "read",
+            Key={"user_id": user_id, "period": ROLLUPS_READY},
+            ConsistentRead=True,
+        )
+        return "Item" in response
 
-        update_expression = "SET " + ", ".join(update_expr_parts)
-        self.users_table.update_item(
-            Key={"user_id": str(user_id), "bot_id": str(bot_id)},
-            UpdateExpression=update_expression,
-            ExpressionAttributeNames=expr_attr_names,
-            ExpressionAttributeValues=expr_attr_values,
+    # ##############################################################
+    # Processed updates (webhook redelivery dedup)
+    # ##############################################################
+
+    def create_updates_table(self) -> None:
+        client = boto3.client("dynamodb", region_name=self.region_name)
+
+        existing_tables = client.list_tables()["TableNames"]
+        if self.updates_table_name in existing_tables:
+            print(f"Table '{self.updates_table_name}' already exists.")
+            return
+
+        self.updates_table = self.dynamodb.create_table(
+            TableName=self.updates_table_name,
+            KeySchema=[{"AttributeName": "update_key", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "update_key", "AttributeType": "S"}],
+            ProvisionedThroughput={"ReadCapacityUnits": 1, "WriteCapacityUnits": 1},
+        )
+        self.updates_table.wait_until_exists()
+        client.update_time_to_live(
+            TableName=self.updates_table_name,
+            TimeToLiveSpecification={"Enabled": True, "AttributeName": "expires_at"},
+        )
+        print(f"Table '{self.updates_table_name}' created.")
+
+    def claim_update(self, bot_id: str, update_id: int, ttl_seconds: int = 86400) -> bool:
+        now = int(time.time())
+        try:
+            # TTL deletion is lazy, so expired items may still be there
+            self._request(
+                self.updates_table.put_item,
+                self.updates_table_name,
+                "write",
+                Item={"update_key": f"{bot_id}:{update_id}", "expires_at": now + ttl_seconds},
+                ConditionExpression="attribute_not_exists(update_key) OR expires_at < :now",
+                ExpressionAttributeValues={":now": now},
+            )
+            return True
+        except self.dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def release_update(self, bot_id: str, update_id: int) -> None:
+        self._request(
+            self.updates_table.delete_item,
+            self.updates_table_name,
+            "write",
+            Key={"update_key": f"{bot_id}:{update_id}"},
         )
 
 
@@ -292,5 +818,9 @@ if __name__ == "__main__":
     db = ExpenseDB(region_name="eu-central-1")
 
     # Create tables
-    db.create_table()
-    db.create_users_table()
+    db.create_tables()
+
+    # Build rollups ahead of the first stats request (comma separated bot ids)
+    for bot_id in filter(None, os.getenv("ROLLUP_BACKFILL_BOTS", "").split(",")):
+        for user in db.get_fields_by_bot(bot_id):
+            db.rebuild_rollups(user["user_id"])
@@ -0,0 +1,453 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import date
+from decimal import Decimal
+from typing import List, Dict, Any, Union, Optional, Iterator, Tuple
+from utils.storage import BaseExpenseDB, ConditionFailed, ROLLUPS_READY, fmt_date
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT NOT NULL,
+    bot_id TEXT NOT NULL,
+    item TEXT NOT NULL,
+    PRIMARY KEY (user_id, bot_id)
+);
+CREATE INDEX IF NOT EXISTS users_bot_idx ON users (bot_id, user_id);
+
+CREATE TABLE IF NOT EXISTS expenses (
+    user_id TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    date TEXT NOT NULL,
+    amount TEXT NOT NULL,
+    category TEXT NOT NULL,
+    currency TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    income INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, timestamp)
+);
+CREATE INDEX IF NOT EXISTS expenses_user_date_idx ON expenses (user_id, date, timestamp);
+
+CREATE TABLE IF NOT EXISTS rollups (
+    user_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    counter TEXT NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (user_id, period, counter)
+);
+
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_key TEXT PRIMARY KEY,
+    expires_at INTEGER NOT NULL
+);
+"""
+
+EXPENSE_COLUMNS = (
+    "user_id",
+    "timestamp",
+    "date",
+    "amount",
+    "category",
+    "currency",
+    "description",
+    "income",
+)
+
+
+def _to_json(item: Dict[str, Any]) -> str:
+    return json.dumps(item, default=lambda o: float(o) if isinstance(o, Decimal) else str(o))
+
+
+def _from_json(raw: str) -> Dict[str, Any]:
+    # Decimal numbers, as boto3 returns them
+    return json.loads(raw, parse_float=Decimal)
+
+
+def _expense_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+    item = dict(row)
+    if "amount" in item:
+        item["amount"] = Decimal(item["amount"])
+    if "income" in item:
+        item["income"] = bool(item["income"])
+    return item
+
+
+def _select_columns(fields: Optional[List[str]]) -> str:
+    if not fields:
+        return "*"
+    unknown = set(fields) - set(EXPENSE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown expense fields: {sorted(unknown)}")
+    return ", ".join(fields)
+
+
+def _expense_to_row(item: Dict[str, Any]) -> tuple:
+    return (
+        str(item["user_id"]),
+        item["timestamp"],
+        item["date"],
+        str(item["amount"]),
+        str(item["category"]),
+        item.get("currency", "USD"),
+        item.get("description", ""),
+        int(bool(item.get("income", False))),
+    )
+
+
+class SQLiteExpenseDB(BaseExpenseDB):
+    """
+    Embedded SQLite backend (WAL mode) for self-hosted polling deployments and load
+    tests. Each worker thread gets its own connection so readers never block.
+    """
+
+    # A single writer at a time, bigger batches instead of concurrent ones
+    purge_workers = 1
+    purge_chunk_size = 500
+
+    def __init__(self, path: str = "expenses.db", max_pool_connections: int = 4):
+        self.path = path
+        self.max_pool_connections = max_pool_connections
+        self._local = threading.local()
+        self.create_tables()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction; IMMEDIATE takes the write lock up front."""
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.conn
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def create_tables(self) -> None:
+        self.conn.executescript(SCHEMA)
+
+    # ##############################################################
+    # Users
+    # ##############################################################
+
+    def get_user(self, user_id: str, bot_id: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute(
+            "SELECT item FROM users WHERE user_id = ? AND bot_id = ?", (str(user_id), str(bot_id))
+        ).fetchone()
+        return _from_json(row["item"]) if row else None
+
+    def put_user(self, item: Dict[str, Any]) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO users (user_id, bot_id, item) VALUES (?, ?, ?)",
+            (str(item["user_id"]), str(item["bot_id"]), _to_json(item)),
+        )
+
+    def delete_user(self, user_id: str, bot_id: str) -> None:
+        self.conn.execute(
+            "DELETE FROM users WHERE user_id = ? AND bot_id = ?", (str(user_id), str(bot_id))
+        )
+
+    def _get_user_fields(self, user_id: str, bot_id: str, fields: List[str]) -> Dict[str, Any]:
+        item = self.get_user(user_id, bot_id) or {}
+        return {f: item[f] for f in fields if f in item}
+
+    def _modify_user(self, user_id: str, bot_id: str, modify) -> Dict[str, Any]:
+        """Read-modify-write of a Users item inside one write transaction."""
+        user_id, bot_id = str(user_id), str(bot_id)
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT item FROM users WHERE user_id = ? AND bot_id = ?", (user_id, bot_id)
+            ).fetchone()
+            item = _from_json(row["item"]) if row else {"user_id": user_id, "bot_id": bot_id}
+            modify(item)
+            conn.execute(
+                "INSERT OR REPLACE INTO users (user_id, bot_id, item) VALUES (?, ?, ?)",
+                (user_id, bot_id, _to_json(item)),
+            )
+        return item
+
+    def _update_user(
+        self,
+        user_id: str,
+        bot_id: str,
+        set_values: Dict[str, Any],
+        add_values: Dict[str, Union[int, float]] = None,
+    ) -> Dict[str, Any]:
+        def modify(item):
+            item.update(set_values)
+            for key, val in (add_values or {}).items():
+                item[key] = item.get(key, 0) + val
+
+        item = self._modify_user(user_id, bot_id, modify)
+        return {key: item[key] for key in [*set_values, *(add_values or {})]}
+
+    def count_request(
+        self, user_id: str, bot_id: str, day: str, cap: int, timestamp: str, cost: int = 1
+    ) -> Tuple[bool, int]:
+        result = {}
+
+        def modify(item):
+            if item.get("rl_day") != day:
+                item["rl_day"], item["daily_requests"] = day, 0
+            result["counted"] = item["daily_requests"] < cap
+            if result["counted"]:
+                item["daily_requests"] += cost
+                item["last_active"] = timestamp
+                item["total_requests"] = item.get("total_requests", 0) + 1
+
+        item = self._modify_user(user_id, bot_id, modify)
+        return result["counted"], int(item["daily_requests"])
+
+    def _set_categories_active(self, user_id: str, bot_id: str, states: Dict[str, int]) -> None:
+        def modify(item):
+            cats = item.get("categories", {})
+            if not set(states) <= set(cats):
+                raise ConditionFailed(f"Unknown categories: {list(states)}")
+            for cat_id, active in states.items():
+                cats[cat_id]["active"] = active
+
+        self._modify_user(user_id, bot_id, modify)
+
+    def _put_category(
+        self, user_id: str, bot_id: str, cat_id: str, category: Dict[str, Any], seen_count: int
+    ) -> None:
+        def modify(item):
+            cats = item.get("categories", {})
+            if cat_id in cats or len(cats) != seen_count:
+                raise ConditionFailed("Categories changed since they were read")
+            cats[cat_id] = category
+
+        self._modify_user(user_id, bot_id, modify)
+
+    def _iter_bot_users(self, bot_id: str) -> Iterator[Dict[str, Any]]:
+        rows = self.conn.execute(
+            "SELECT item FROM users WHERE bot_id = ? ORDER BY user_id", (str(bot_id),)
+        ).fetchall()
+        for row in rows:
+            yield _from_json(row["item"])
+
+    def get_fields_by_bot(self, bot_id: str, fields=["user_id"]) -> List[Dict[str, Any]]:
+        return [{f: u[f] for f in fields if f in u} for u in self._iter_bot_users(bot_id)]
+
+    def get_users_bulk(
+        self, user_ids: List[str], bot_id: str, fields: List[str]
+    ) -> Dict[str, Dict[str, Any]]:
+        fields = list(dict.fromkeys(["user_id", *fields]))
+        users = {}
+        for i in range(0, len(user_ids), 500):
+            chunk = [str(uid) for uid in user_ids[i : i + 500]]
+            rows = self.conn.execute(
+                f"SELECT user_id, item FROM users WHERE bot_id = ? "
+                f"AND user_id IN ({', '.join('?' * len(chunk))})",
+                (str(bot_id), *chunk),
+            )
+            for row in rows:
+                item = _from_json(row["item"])
+                users[row["user_id"]] = {f: item[f] for f in fields if f in item}
+        return users
+
+    def get_users_with_reminders(self, bot_id: str) -> List[str]:
+        return [u["user_id"] for u in self._iter_bot_users(bot_id) if u.get("daily_reminders")]
+
+    # ##############################################################
+    # Expenses
+    # ##############################################################
+
+    def _put_expense(self, item: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                f"INSERT OR REPLACE INTO expenses ({', '.join(EXPENSE_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(EXPENSE_COLUMNS))})",
+                _expense_to_row(item),
+            )
+            self._add_rollups(conn, [item])
+
+    def iter_expenses(
+        self,
+        user_id: str,
+        start_date: Union[str, date],
+        end_date: Union[str, date],
+        page_size: int = 500,
+        fields: List[str] = None,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        # Keyset pagination over the (user_id, date, timestamp) index
+        columns = _select_columns(fields)
+        last = ("", "")
+        while True:
+            rows = self.conn.execute(
+                f"SELECT {columns}, date AS _date, timestamp AS _ts FROM expenses "
+                "WHERE user_id = ? AND date BETWEEN ? AND ? "
+                "AND (date, timestamp) > (?, ?) ORDER BY date, timestamp LIMIT ?",
+                (str(user_id), fmt_date(start_date), fmt_date(end_date), *last, page_size),
+            ).fetchall()
+            if not rows:
+                break
+            last = (rows[-1]["_date"], rows[-1]["_ts"])
+            page = [_expense_from_row(r) for r in rows]
+            for item in page:
+                del item["_date"], item["_ts"]
+            yield page
+            if len(rows) < page_size:
+                break
+
+    def get_expense(self, user_id: str, timestamp: str) -> Optional[Dict[str, Any]]:
+        row = self.conn.execute(
+            "SELECT * FROM expenses WHERE user_id = ? AND timestamp = ?", (str(user_id), timestamp)
+        ).fetchone()
+        return _expense_from_row(row) if row else None
+
+    def fetch_latest_expenses(
+        self, user_id: str, limit: int = 50, ascending=False, fields: List[str] = None
+    ) -> List[Dict[str, Any]]:
+        order = "ASC" if ascending else "DESC"
+        rows = self.conn.execute(
+            f"SELECT {_select_columns(fields)} FROM expenses WHERE user_id = ? ORDER BY timestamp {order} LIMIT ?",
+            (str(user_id), limit),
+        ).fetchall()
+        return [_expense_from_row(r) for r in reversed(rows)]
+
+    def remove_expense(self, user_id: str, timestamp: str) -> Optional[Dict[str, Any]]:
+        with self._transaction() as conn:
+            row = conn.execute(
+                "DELETE FROM expenses WHERE user_id = ? AND timestamp = ? RETURNING *",
+                (str(user_id), timestamp),
+            ).fetchone()
+            if row is None:
+                return None
+            item = _expense_from_row(row)
+            self._add_rollups(conn, [item], sign=-1)
+        return item
+
+    def remove_batch_records(self, records: dict) -> bool:
+        with self._transaction() as conn:
+            conn.executemany(
+                "DELETE FROM expenses WHERE user_id = ? AND timestamp = ?",
+                [(str(item["user_id"]), item["timestamp"]) for item in records],
+            )
+            self._add_rollups(conn, records, sign=-1)
+
+    def _delete_expense_keys(self, keys: List[Dict[str, str]]) -> None:
+        with self._transaction() as conn:
+            conn.executemany(
+                "DELETE FROM expenses WHERE user_id = ? AND timestamp = ?",
+                [(str(key["user_id"]), key["timestamp"]) for key in keys],
+            )
+
+    def insert_batch_records(self, records: list) -> bool:
+        try:
+            with self._transaction() as conn:
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO expenses ({', '.join(EXPENSE_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(EXPENSE_COLUMNS))})",
+                    [_expense_to_row(item) for item in records],
+                )
+                self._add_rollups(conn, records)
+            return True
+        except Exception as e:
+            print(f"Error inserting batch records: {e}")
+            return False
+
+    # ##############################################################
+    # Rollups
+    # ##############################################################
+
+    def _add_rollups(
+        self, conn: sqlite3.Connection, records: List[Dict[str, Any]], sign: int = 1
+    ) -> None:
+        """Add the records to their rollups inside the caller's transaction."""
+        conn.executemany(
+            "INSERT INTO rollups (user_id, period, counter, value) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id, period, counter) DO UPDATE SET value = value + excluded.value",
+            [
+                (str(user_id), period, name, float(value))
+                for (user_id, period), counters in self._rollup_deltas(records, sign).items()
+                for name, value in counters.items()
+            ],
+        )
+
+    def iter_rollups(
+        self,
+        user_id: str,
+        granularity: str,
+        start_date: Union[str, date],
+        end_date: Union[str, date],
+    ) -> Iterator[Dict[str, Any]]:
+        start_date, end_date = fmt_date(start_date), fmt_date(end_date)
+        if granularity == "M":
+            start_date, end_date = start_date[:7], end_date[:7]
+        rows = self.conn.execute(
+            "SELECT period, counter, value FROM rollups WHERE user_id = ? "
+            "AND period BETWEEN ? AND ? ORDER BY period",
+            (str(user_id), f"{granularity}#{start_date}", f"{granularity}#{end_date}"),
+        ).fetchall()
+        item = None
+        for row in rows:
+            if item is None or item["period"] != row["period"]:
+                if item is not None:
+                    yield item
+                item = {"user_id": str(user_id), "period": row["period"]}
+            item[row["counter"]] = Decimal(str(round(row["value"], 2)))
+        if item is not None:
+            yield item
+
+    def _replace_rollups(self, user_id: str, deltas: Dict[tuple, dict]) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM rollups WHERE user_id = ?", (str(user_id),))
+            conn.executemany(
+                "INSERT INTO rollups (user_id, period, counter, value) VALUES (?, ?, ?, ?)",
+                [
+                    (uid, period, name, float(value))
+                    for (uid, period), counters in deltas.items()
+                    for name, value in counters.items()
+                ],
+            )
+            conn.execute(
+                "INSERT INTO rollups (user_id, period, counter, value) VALUES (?, ?, 'ready', 1)",
+                (str(user_id), ROLLUPS_READY),
+            )
+
+    def _invalidate_rollups(self, user_id: str) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "DELETE FROM rollups WHERE user_id = ? AND period = ?",
+                (str(user_id), ROLLUPS_READY),
+            )
+
+    def _rollups_ready(self, user_id: str) -> bool:
+        row = self.conn.execute(
+            "SELECT 1 FROM rollups WHERE user_id = ? AND period = ?", (str(user_id), ROLLUPS_READY)
+        ).fetchone()
+        return row is not None
+
+    # ##############################################################
+    # Processed updates (webhook redelivery dedup)
+    # ##############################################################
+
+    def claim_update(self, bot_id: str, update_id: int, ttl_seconds: int = 86400) -> bool:
+        now = int(time.time())
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO processed_updates (update_key, expires_at) VALUES (?, ?) "
+                "ON CONFLICT (update_key) DO UPDATE SET expires_at = excluded.expires_at "
+                "WHERE processed_updates.expires_at < ?",
+                (f"{bot_id}:{update_id}", now + ttl_seconds, now),
+            )
+            conn.execute("DELETE FROM processed_updates WHERE expires_at < ?", (now,))
+        return cursor.rowcount == 1
+
+    def release_update(self, bot_id: str, update_id: int) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "DELETE FROM processed_updates WHERE update_key = ?", (f"{bot_id}:{update_id}",)
+            )
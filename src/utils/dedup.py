@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from typing import Optional
+from utils.startup import Lazy
+
+
+class UpdateDeduplicator:
+    """
+    Drops Telegram webhook redeliveries. Ids seen by this container are answered from
+    memory. With a storage (opt-in, one conditional write per update) the update_id is
+    also claimed, so a retry that lands on another container is dropped as well.
+
+    A claim is only released when processing fails with an exception: an update whose
+    invocation times out after the claim is never processed, its redeliveries are
+    dropped until the claim expires (ttl_seconds).
+    """
+
+    def __init__(
+        self,
+        bot_id: str,
+        db: Optional[Lazy] = None,
+        max_recent: int = 1000,
+        ttl_seconds: int = 86400,
+    ):
+        self.bot_id = str(bot_id)
+        # Built on the first claim only, memory-only dedup never touches storage
+        self.db = db
+        self.max_recent = max_recent
+        self.ttl_seconds = ttl_seconds
+        self.recent: OrderedDict[int, None] = OrderedDict()
+
+    def _remember(self, update_id: int) -> None:
+        self.recent[update_id] = None
+        while len(self.recent) > self.max_recent:
+            self.recent.popitem(last=False)
+
+    async def is_duplicate(self, update_id: int) -> bool:
+        if update_id in self.recent:
+            return True
+        claimed = True
+        if self.db is not None:
+            try:
+                claimed = await self.db.get().claim_update(self.bot_id, update_id, self.ttl_seconds)
+            except Exception as e:
+                # Better to process twice than to drop an update
+                print(f"Error claiming update {update_id}: {e}")
+        self._remember(update_id)
+        return not claimed
+
+    async def release(self, update_id: int) -> None:
+        """Forget an update whose processing failed so that its retry goes through."""
+        self.recent.pop(update_id, None)
+        if self.db is None:
+            return
+        try:
+            await self.db.get().release_update(self.bot_id, update_id)
+        except Exception as e:
+            print(f"Error releasing update {update_id}: {e}")
@@ -1,13 +1,18 @@
-import requests
+from typing import TYPE_CHECKING
 from telegram import Update
 from telegram.ext import ContextTypes
-from utils.db import ExpenseDB
-from utils.llm import AIClient
 from utils.dates import get_date_with_tz
+from utils.http import sync_client
+from utils.startup import Lazy
+from utils.user_record import UserRecord
+
+if TYPE_CHECKING:
+    from utils.async_db import AsyncExpenseDB
+    from utils.llm import AIClient
 
 
 def single_msg(msg, token, chat_id):
-    return requests.post(
+    return sync_client().post(
         f"https://api.telegram.org/bot{token}/sendMessage",
         json={"chat_id": int(chat_id), "text": msg},
     )
@@ -16,7 +21,7 @@ def single_msg(msg, token, chat_id):
 def send_typing_action_raw(token: str, chat_id: int):
     url = f"https://api.telegram.org/bot{token}/sendChatAction"
     payload = {"chat_id": chat_id, "action": "typing"}
-    response = requests.post(url, data=payload)
+    response = sync_client().post(url, data=payload)
     return response.json()
 
 
@@ -24,17 +29,42 @@ def truncate(text, max_len=15):
     return text if len(text) <= max_len else text[: max_len - 1] + "…"
 
 
-def get_db(context: ContextTypes.DEFAULT_TYPE) -> ExpenseDB:
-    return context.bot_data.get("db")
+def _resolve(resource):
+    # bot_data resources may be built lazily on first use
+    return resource.get() if isinstance(resource, Lazy) else resource
+
+
+def get_db(context: ContextTypes.DEFAULT_TYPE) -> "AsyncExpenseDB":
+    return _resolve(context.bot_data.get("db"))
+
+
+def get_ai_client(context: ContextTypes.DEFAULT_TYPE) -> "AIClient":
+    return _resolve(context.bot_data.get("llm"))
+
+
+def get_user_record(context: ContextTypes.DEFAULT_TYPE) -> UserRecord:
+    """Users item loaded by rate_counter for the current update (None outside of it)."""
+    return getattr(context, "user_record", None)
 
 
-def get_ai_client(context: ContextTypes.DEFAULT_TYPE) -> AIClient:
-    return context.bot_data.get("llm")
+def use_quota(context: ContextTypes.DEFAULT_TYPE, kind: str) -> bool:
+    """
+    Take one unit of a daily quota ("llm", "scan") for an expensive operation the
+    handler decides on at runtime. Always allowed outside of rate_counter.
+    """
+    rlim = getattr(context, "rate_limiter", None)
+    if rlim is None:
+        return True
+    return rlim.use_quota(kind, get_user_record(context))
 
 
-def get_active_categories(db: ExpenseDB, user_id: str, bot_id: str) -> dict:
+async def get_active_categories(
+    db: "AsyncExpenseDB", user_id: str, bot_id: str, record: UserRecord = None
+) -> dict:
     return {
-        k: v for k, v in db.get_fields(user_id, bot_id, "categories").items() if v["active"] == 1
+        k: v
+        for k, v in (await db.get_fields(user_id, bot_id, "categories", record=record)).items()
+        if v["active"] == 1
     }
 
 
@@ -0,0 +1,66 @@
+import os
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import httpx
+    from telegram.request import HTTPXRequest
+
+# Outbound HTTP settings shared by the Bot API and OpenAI clients
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "60"))
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "10"))
+WRITE_TIMEOUT = float(os.getenv("HTTP_WRITE_TIMEOUT", "10"))
+POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "5"))
+HTTP2 = os.getenv("HTTP2", "0") == "1"
+
+_sync_client = None
+
+
+def sync_client() -> "httpx.Client":
+    """
+    Keep-alive pool for blocking calls (OpenAI, raw Bot API calls). Built once per
+    container and reused by warm invocations.
+    """
+    global _sync_client
+    if _sync_client is None:
+        import httpx
+
+        _sync_client = httpx.Client(
+            limits=httpx.Limits(
+                max_connections=POOL_SIZE,
+                max_keepalive_connections=POOL_SIZE,
+                keepalive_expiry=KEEPALIVE_SECONDS,
+            ),
+            timeout=httpx.Timeout(
+                connect=CONNECT_TIMEOUT,
+                read=READ_TIMEOUT,
+                write=WRITE_TIMEOUT,
+                pool=POOL_TIMEOUT,
+            ),
+            http2=HTTP2,
+        )
+    return _sync_client
+
+
+def telegram_request(
+    pool_size: int = POOL_SIZE, read_timeout: float = READ_TIMEOUT
+) -> "HTTPXRequest":
+    """Async pool of the bot (python-telegram-bot's httpx backend) with the same settings."""
+    from telegram.request import HTTPXRequest
+
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        read_timeout=read_timeout,
+        write_timeout=WRITE_TIMEOUT,
+        connect_timeout=CONNECT_TIMEOUT,
+        pool_timeout=POOL_TIMEOUT,
+        http_version="2" if HTTP2 else "1.1",
+    )
+
+
+def close_sync_client() -> None:
+    global _sync_client
+    if _sync_client is not None:
+        _sync_client.close()
+        _sync_client = None
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+# Update types that carry the user who sent them
+_SENDER_FIELDS = [
+    "message",
+    "edited_message",
+    "callback_query",
+    "pre_checkout_query",
+    "shipping_query",
+    "inline_query",
+    "chosen_inline_result",
+    "my_chat_member",
+]
+
+
+def update_owner(body: Dict[str, Any]) -> str:
+    """Key that orders the updates of a user; updates without a sender are independent."""
+    for field in _SENDER_FIELDS:
+        sender = (body.get(field) or {}).get("from")
+        if sender:
+            return str(sender["id"])
+    return f"update:{body.get('update_id')}"
+
+
+class UpdateFailed(Exception):
+    """A handler raised while processing the update."""
+
+
+# Exceptions of the update being processed, filled by the Application's error handler
+_handler_errors: ContextVar[Optional[List[BaseException]]] = ContextVar(
+    "handler_errors", default=None
+)
+
+
+def record_handler_error(error: BaseException) -> None:
+    errors = _handler_errors.get()
+    if errors is not None:
+        errors.append(error)
+
+
+@contextmanager
+def collect_handler_errors():
+    """
+    Application.process_update hands handler exceptions to the error handlers and
+    never raises them. Inside, the error handler records them (record_handler_error)
+    so the caller can tell that the update failed.
+    """
+    errors: List[BaseException] = []
+    token = _handler_errors.set(errors)
+    try:
+        yield errors
+    finally:
+        _handler_errors.reset(token)
+
+
+async def process_batch(
+    records: List[Dict[str, Any]],
+    handle: Callable[[Dict[str, Any]], Awaitable[Any]],
+    max_concurrency: int = 32,
+) -> Dict[str, List[Dict[str, str]]]:
+    """
+    Run the updates of an SQS batch event. Users are processed concurrently, the
+    updates of each user one after another in queue order. When one fails, it and
+    the later updates of the same user are reported as partial batch failures
+    (the event source mapping needs ReportBatchItemFailures) so they are retried
+    in order. Bodies that are not JSON are dropped, a retry would not fix them.
+    """
+    by_user: Dict[str, list] = {}
+    for record in records:
+        try:
+            body = json.loads(record["body"])
+        except ValueError:
+            print(f"Dropping malformed message {record['messageId']}")
+            continue
+        by_user.setdefault(update_owner(body), []).append((record["messageId"], body))
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_user(items: list) -> List[str]:
+        async with semaphore:
+            for i, (message_id, body) in enumerate(items):
+                try:
+                    await handle(body)
+                except Exception as e:
+                    print(f"Error processing message {message_id}: {e}")
+                    return [m for m, _ in items[i:]]
+        return []
+
+    failed = await asyncio.gather(*(run_user(items) for items in by_user.values()))
+    return {"batchItemFailures": [{"itemIdentifier": m} for ids in failed for m in ids]}
+
+
+class SqsQueue:
+    """Webhook side of the ingestion queue. FIFO queues are grouped by user."""
+
+    def __init__(self, queue_url: str, region_name: str):
+        import boto3
+
+        self.queue_url = queue_url
+        self.client = boto3.client("sqs", region_name=region_name)
+
+    def send(self, body: Dict[str, Any]) -> str:
+        params = {"QueueUrl": self.queue_url, "MessageBody": json.dumps(body)}
+        if self.queue_url.endswith(".fifo"):
+            params["MessageGroupId"] = update_owner(body)
+            params["MessageDeduplicationId"] = str(body["update_id"])
+        return self.client.send_message(**params)["MessageId"]
+
+
+class InMemoryQueue:
+    """
+    Stand-in for SqsQueue in tests and local runs, which drive it themselves:
+    receive() builds the batch event Lambda would be invoked with and requeue() puts
+    back the failures reported for it. Nothing consumes it in Lambda.
+    """
+
+    def __init__(self, batch_size: int = 10):
+        self.batch_size = batch_size
+        self.messages: deque = deque()
+
+    def send(self, body: Dict[str, Any]) -> str:
+        message_id = str(uuid.uuid4())
+        self.messages.append(
+            {"messageId": message_id, "body": json.dumps(body), "eventSource": "aws:sqs"}
+        )
+        return message_id
+
+    def receive(self, max_messages: Optional[int] = None) -> Dict[str, List[Dict[str, Any]]]:
+        n = min(max_messages or self.batch_size, len(self.messages))
+        return {"Records": [self.messages.popleft() for _ in range(n)]}
+
+    def requeue(self, event: Dict[str, Any], response: Dict[str, Any]) -> None:
+        failed = {f["itemIdentifier"] for f in response.get("batchItemFailures", [])}
+        for record in reversed(event["Records"]):
+            if record["messageId"] in failed:
+                self.messages.appendleft(record)
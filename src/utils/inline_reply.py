@@ -0,0 +1,97 @@
+import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+from telegram.request import BaseRequest, RequestData
+
+# Methods whose result the handlers never read: they get True instead of the Message
+INLINE_METHODS = {
+    "sendMessage",
+    "editMessageText",
+    "editMessageReplyMarkup",
+    "answerCallbackQuery",
+    "answerPreCheckoutQuery",
+    "deleteMessage",
+    "sendChatAction",
+}
+
+_reply: ContextVar[Optional["InlineReply"]] = ContextVar("inline_reply", default=None)
+
+
+class InlineReply:
+    """The first Bot API call of an update, answered in the webhook response."""
+
+    def __init__(self):
+        self.call: Optional[Tuple] = None
+        self.payload: Optional[Dict[str, Any]] = None
+        # Set once any call went through the client, later ones can't be deferred
+        self.closed = False
+
+    def webhook_response(self) -> Dict[str, Any]:
+        return {
+            "statusCode": 200,
+            "headers": {"Content-Type": "application/json"},
+            "body": json.dumps(self.payload),
+        }
+
+
+@contextmanager
+def capture_first_call():
+    """
+    Defer the first Bot API call made inside (the handling of one update) so it can
+    be returned as the webhook response body: Telegram runs it after the response,
+    saving an outbound round trip. If a second call is made, the deferred one is sent
+    first so the order of the calls is kept.
+    """
+    reply = InlineReply()
+    token = _reply.set(reply)
+    try:
+        yield reply
+    finally:
+        _reply.reset(token)
+
+
+class InlineReplyRequest(BaseRequest):
+    """Bot request backend that defers calls to capture_first_call, wraps another one."""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return self.inner.read_timeout
+
+    async def initialize(self) -> None:
+        await self.inner.initialize()
+
+    async def shutdown(self) -> None:
+        await self.inner.shutdown()
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData = None,
+        *args,
+        **kwargs,
+    ) -> Tuple[int, bytes]:
+        reply = _reply.get()
+        if reply is not None and not reply.closed:
+            if reply.call is None:
+                api_method = url.rsplit("/", 1)[1]
+                if api_method in INLINE_METHODS and not (
+                    request_data and request_data.contains_files
+                ):
+                    reply.call = (url, method, request_data, args, kwargs)
+                    reply.payload = {
+                        "method": api_method,
+                        **(request_data.parameters if request_data else {}),
+                    }
+                    return 200, b'{"ok": true, "result": true}'
+            else:
+                # Keep the order: the deferred call goes out before this one
+                d_url, d_method, d_data, d_args, d_kwargs = reply.call
+                reply.call = reply.payload = None
+                await self.inner.do_request(d_url, d_method, d_data, *d_args, **d_kwargs)
+            reply.closed = True
+        return await self.inner.do_request(url, method, request_data, *args, **kwargs)
@@ -1,14 +1,21 @@
-from openai import OpenAI, RateLimitError
+import asyncio
+from utils.http import sync_client
 
 
 class AIClient:
     def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key, max_retries=0, timeout=4)
+        # openai is heavy to import, only pay for it when a client is actually built
+        from openai import OpenAI
+
+        # Connections come from the shared keep-alive pool, see utils.http
+        self.client = OpenAI(api_key=api_key, max_retries=0, timeout=4, http_client=sync_client())
 
     def generate_response(self, prompt: str, model: str = "gpt-4o-mini") -> str:
         """
         Generate a response from the OpenAI API based on the given prompt.
         """
+        from openai import RateLimitError
+
         try:
             completion = self.client.chat.completions.create(
                 model=model,
@@ -23,3 +30,7 @@ class AIClient:
         except Exception as e:
             print("Error from OpenAI request:", e)
             return None
+
+    async def agenerate_response(self, prompt: str, model: str = "gpt-4o-mini") -> str:
+        """generate_response in a worker thread, so other updates go on meanwhile."""
+        return await asyncio.to_thread(self.generate_response, prompt, model)
@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Union
+
+# Name of the handler (or scheduled job) the current storage calls are made for
+current_handler: ContextVar[str] = ContextVar("current_handler", default="-")
+_update_usage: ContextVar[Optional["Usage"]] = ContextVar("update_usage", default=None)
+
+
+class Usage:
+    """Storage calls, consumed capacity units and wall time spent in them."""
+
+    def __init__(self):
+        self.calls = 0
+        self.rcu = 0.0
+        self.wcu = 0.0
+        self.seconds = 0.0
+
+    def add(self, rcu: float, wcu: float, seconds: float) -> None:
+        self.calls += 1
+        self.rcu += rcu
+        self.wcu += wcu
+        self.seconds += seconds
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "rcu": round(self.rcu, 2),
+            "wcu": round(self.wcu, 2),
+            "db_ms": round(self.seconds * 1000, 1),
+        }
+
+
+class UsageMeter:
+    """Per handler totals since the container started. Storage threads write to it."""
+
+    def __init__(self):
+        self.by_handler: Dict[str, Usage] = {}
+        self.updates: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def add(self, handler: str, rcu: float, wcu: float, seconds: float) -> None:
+        with self.lock:
+            self.by_handler.setdefault(handler, Usage()).add(rcu, wcu, seconds)
+
+    def count_update(self, handler: str) -> None:
+        with self.lock:
+            self.updates[handler] = self.updates.get(handler, 0) + 1
+
+    def report(self) -> List[Dict[str, Any]]:
+        """Handlers by total capacity consumed, most expensive first."""
+        with self.lock:
+            rows = [
+                {"handler": name, "updates": self.updates.get(name, 0), **usage.as_dict()}
+                for name, usage in self.by_handler.items()
+            ]
+        return sorted(rows, key=lambda r: r["rcu"] + r["wcu"], reverse=True)
+
+
+METER = UsageMeter()
+
+
+def capacity_units(
+    consumed: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]], kind: str
+) -> tuple:
+    """(RCU, WCU) of a ConsumedCapacity response, table and indexes included."""
+    rcu = wcu = 0.0
+    for entry in consumed if isinstance(consumed, list) else [consumed] if consumed else []:
+        total = entry.get("CapacityUnits", 0)
+        rcu += entry.get("ReadCapacityUnits", total if kind == "read" else 0)
+        wcu += entry.get("WriteCapacityUnits", total if kind == "write" else 0)
+    return rcu, wcu
+
+
+def record_request(rcu: float, wcu: float, seconds: float) -> None:
+    METER.add(current_handler.get(), rcu, wcu, seconds)
+    usage = _update_usage.get()
+    if usage is not None:
+        usage.add(rcu, wcu, seconds)
+
+
+@contextmanager
+def track_update(handler: str):
+    """
+    Tag the storage calls made inside with the handler name and log their totals
+    as one line when it exits.
+    """
+    usage = Usage()
+    handler_token = current_handler.set(handler)
+    usage_token = _update_usage.set(usage)
+    start = time.perf_counter()
+    try:
+        yield usage
+    finally:
+        current_handler.reset(handler_token)
+        _update_usage.reset(usage_token)
+        METER.count_update(handler)
+        print(
+            json.dumps(
+                {
+                    "handler": handler,
+                    "total_ms": round((time.perf_counter() - start) * 1000, 1),
+                    **usage.as_dict(),
+                }
+            )
+        )
@@ -0,0 +1,61 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# Telegram message length limit
+MAX_MESSAGE_LEN = 4096
+
+
+class Notifier:
+    """
+    Messages for the operator chat. notify() only queues them, repeated messages
+    are counted instead of queued twice, and flush() sends everything as one digest
+    through the bot's client.
+
+    Lambda flushes with force=True at the end of every invocation. Long-running
+    processes (polling) flush as errors come: digests go out at most every
+    min_interval seconds, and what is queued in between is sent when it ends.
+    """
+
+    def __init__(self, chat_id: int, min_interval: float = 60):
+        self.chat_id = chat_id
+        self.min_interval = min_interval
+        self.pending: OrderedDict[str, int] = OrderedDict()
+        self.last_sent = float("-inf")
+        self._scheduled = None
+
+    def notify(self, msg: str) -> None:
+        self.pending[msg] = self.pending.get(msg, 0) + 1
+
+    def error(self, where: str, exc: BaseException) -> None:
+        self.notify(f"ERROR in {where}: {type(exc).__name__}: {exc}")
+
+    def digest(self) -> Optional[str]:
+        if not self.pending:
+            return None
+        lines = [msg if n == 1 else f"{msg} (x{n})" for msg, n in self.pending.items()]
+        text = "\n".join(lines)
+        return text if len(text) <= MAX_MESSAGE_LEN else text[: MAX_MESSAGE_LEN - 1] + "…"
+
+    async def flush(self, bot, force: bool = False) -> None:
+        if not self.pending:
+            return
+        wait = self.last_sent + self.min_interval - time.monotonic()
+        if not force and wait > 0:
+            if self._scheduled is None:
+                self._scheduled = asyncio.create_task(self._flush_later(bot, wait))
+            return
+        text = self.digest()
+        self.pending.clear()
+        self.last_sent = time.monotonic()
+        try:
+            await bot.send_message(chat_id=self.chat_id, text=text)
+        except Exception as e:
+            # Never let reporting fail the update
+            print(f"Error sending notifications: {e}\n{text}")
+
+    async def _flush_later(self, bot, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._scheduled = None
+        await self.flush(bot, force=True)
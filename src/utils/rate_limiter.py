@@ -1,12 +1,137 @@
+import time
+from collections import OrderedDict
 from datetime import datetime
-from utils.db import ExpenseDB
+from typing import Dict, Tuple
+from utils.async_db import AsyncExpenseDB
+from utils.dates import parse_timezone
 from utils.general import get_date_with_tz
+from utils.user_record import UserRecord
+
+
+class _Counter:
+    __slots__ = ("day", "daily", "last_active", "pending_daily", "pending_total", "day_synced")
+
+    def __init__(self, day: str, daily: int):
+        self.day = day
+        self.daily = daily
+        self.last_active = None
+        self.pending_daily = 0
+        self.pending_total = 0
+        # False until the stored daily_requests has been set for this day
+        self.day_synced = True
+
+
+class LocalRateStore:
+    """
+    In-process request counters for warm Lambda containers and polling mode.
+
+    Counters live in a bounded LRU keyed by (user_id, bot_id) and are seeded from the
+    user record on first sight. The Users table only receives the accumulated deltas
+    (ADD) every sync_interval seconds and on shutdown, instead of a write per update.
+
+    Meant for long-running processes (polling). Lambda never runs the shutdown hook,
+    so the counts of the last sync_interval seconds are lost when a container is
+    reclaimed.
+    """
+
+    def __init__(self, max_users: int = 10000, sync_interval: float = 60):
+        self.max_users = max_users
+        self.sync_interval = sync_interval
+        self.counters: OrderedDict[Tuple[str, str], _Counter] = OrderedDict()
+        # Counters evicted before their deltas were synced
+        self.evicted: Dict[Tuple[str, str], _Counter] = {}
+        self.last_sync = time.monotonic()
+
+    def get(
+        self, key: Tuple[str, str], today: str, record: UserRecord = None, timezone: str = "UTC"
+    ) -> _Counter:
+        counter = self.counters.get(key)
+        if counter is None:
+            # An evicted counter with unsynced deltas is ahead of the stored record
+            counter = self.evicted.pop(key, None)
+        if counter is None:
+            item = record.item if record is not None else {}
+            last_active = item.get("last_active")
+            same_day = (
+                last_active and get_date_with_tz(timezone, timestamp=int(last_active)) == today
+            )
+            counter = _Counter(today, int(item.get("daily_requests", 0)) if same_day else 0)
+            counter.day_synced = bool(same_day)
+        if key not in self.counters:
+            self.counters[key] = counter
+            while len(self.counters) > self.max_users:
+                old_key, old = self.counters.popitem(last=False)
+                if old.pending_total:
+                    self.evicted[old_key] = old
+        if counter.day != today:
+            counter.day, counter.daily = today, 0
+            counter.pending_daily, counter.day_synced = 0, False
+        self.counters.move_to_end(key)
+        return counter
+
+    def hit(self, counter: _Counter, timestamp: str, cost: int = 1) -> None:
+        counter.daily += cost
+        counter.pending_daily += cost
+        counter.pending_total += 1
+        counter.last_active = timestamp
+
+    def is_sync_due(self) -> bool:
+        return time.monotonic() - self.last_sync >= self.sync_interval
+
+    def _drain(self) -> Dict[Tuple[str, str], tuple]:
+        pending = {}
+        for key, counter in [*self.evicted.items(), *self.counters.items()]:
+            if not counter.pending_total:
+                continue
+            set_values = {"last_active": counter.last_active}
+            add_values = {"total_requests": counter.pending_total}
+            if counter.day_synced:
+                add_values["daily_requests"] = counter.pending_daily
+            else:
+                # First sync of the day overwrites yesterday's count
+                set_values["daily_requests"] = counter.daily
+            pending[key] = (set_values, add_values)
+            counter.pending_daily = counter.pending_total = 0
+            counter.day_synced = True
+        self.evicted = {}
+        return pending
+
+    async def sync(self, db: AsyncExpenseDB, force: bool = False) -> None:
+        """Write the accumulated deltas to the Users table (when due, or always if forced)."""
+        if not force and not self.is_sync_due():
+            return
+        self.last_sync = time.monotonic()
+        for (user_id, bot_id), (set_values, add_values) in self._drain().items():
+            try:
+                await db._update_user(user_id, bot_id, set_values, add_values)
+            except Exception as e:
+                print(f"Error syncing request counters of {user_id}: {e}")
 
 
 class RateLimiter:
-    def __init__(self, user_id: str, bot_id: str, db: ExpenseDB, max_reqs_allowed=100):
+    def __init__(
+        self,
+        user_id: str,
+        bot_id: str,
+        db: AsyncExpenseDB,
+        max_reqs_allowed=100,
+        store: LocalRateStore = None,
+        mode: str = "db",
+        cost: int = 1,
+        quota_caps: Dict[str, int] = None,
+    ):
         self.db = db
+        self.store = store
+        # "db": read then staged write, "local": store counters, "atomic": one conditional write
+        self.mode = "local" if store is not None else mode
         self.max_reqs_allowed = max_reqs_allowed
+        # Units this update uses of the daily budget, and the separate daily caps
+        # ("llm", "scan") of expensive operations
+        self.cost = cost
+        self.quota_caps = quota_caps or {}
+        # Requests over the limit still get a warning, up to this count
+        self.warn_limit = max_reqs_allowed + 5
+        self.timezone = "UTC"
         self.bot_id = str(bot_id)
         self.user_id = str(user_id)
         self.daily_col = "daily_requests"
@@ -15,48 +140,132 @@ class RateLimiter:
         self.key = {"user_id": self.user_id, "bot_id": self.bot_id}
         self.daily_requests = None
         self.total_requests = None
+        # Whether count_request charged the cost (atomic mode)
+        self._counted = False
         self.current_timestamp = str(int(datetime.now().timestamp()))
 
-    def get_current_reqs(self) -> bool:
+    async def get_current_reqs(self, record: UserRecord = None) -> bool:
         """
-        Check if user has exceeded their daily rate limit
+        Check if user has exceeded their daily rate limit. Days follow the user's
+        timezone in every mode; without the already loaded record, the fields are read
+        here first.
         """
-        today = get_date_with_tz()
+        if record is None:
+            record = UserRecord(
+                self.user_id,
+                self.bot_id,
+                await self.db.get_fields(
+                    self.user_id,
+                    self.bot_id,
+                    ["user_timezone", self.daily_col, self.last_act_col, self.total_col],
+                ),
+            )
+        self.timezone = record.get("user_timezone") or "UTC"
+        today = get_date_with_tz(self.timezone)
 
-        # Get today's requests
-        response = self.db.users_table.get_item(
-            Key=self.key,
-            ProjectionExpression=f"{self.daily_col}, {self.last_act_col}, {self.total_col}",
-        ).get("Item", {})
+        if self.mode == "atomic":
+            return await self._count_atomic(today, record)
+
+        if self.mode == "local":
+            self._counter = self.store.get(
+                (self.user_id, self.bot_id), today, record, self.timezone
+            )
+            self.daily_requests = self._counter.daily
+            return
+
+        # Get today's requests from the per-update record
+        response = record.item
         last_date = response.get(self.last_act_col, "")
         daily_requests = response.get(self.daily_col, 0)
         total_requests = response.get(self.total_col, 0)
 
         # Reset counter if it's a new day
-        last_date_fmt = get_date_with_tz(timestamp=int(last_date)) if last_date else None
+        last_date_fmt = (
+            get_date_with_tz(self.timezone, timestamp=int(last_date)) if last_date else None
+        )
         if not last_date_fmt or last_date_fmt != today:
             daily_requests = 0
         self.daily_requests = daily_requests
         self.total_requests = total_requests
 
-    def update_db_reqs(self):
-        self.db.users_table.update_item(
-            Key=self.key,
-            UpdateExpression=f"SET {self.daily_col} = :r, {self.last_act_col} = :d, {self.total_col} = :t",
-            ExpressionAttributeValues={
-                ":r": int(self.daily_requests + 1),
-                ":d": str(self.current_timestamp),
-                ":t": int(self.total_requests + 1),
-            },
+    async def _count_atomic(self, day: str, record: UserRecord) -> None:
+        """
+        Check and count the request with a single conditional UpdateItem, so
+        concurrent containers can't overwrite each other's counts. The record must be
+        loaded already (the timezone giving the day comes from it): reading it here
+        with get_fields would make the check two round trips.
+        """
+        counted, count = await self.db.count_request(
+            self.user_id, self.bot_id, day, self.warn_limit, str(self.current_timestamp), self.cost
         )
+        # Same meaning as in the other modes: requests made before this one
+        self.daily_requests = count - self.cost if counted else count
+        self._counted = counted
+        if counted:
+            record.apply({self.daily_col: count, self.last_act_col: str(self.current_timestamp)})
+
+    async def refuse(self, record: UserRecord = None) -> None:
+        """
+        The handler was not run (daily limit or quota reached): the update counts as a
+        single request instead of its cost.
+        """
+        refund = self.cost - 1
+        self.cost = 1
+        if self.mode != "atomic" or not refund or not self._counted:
+            # The other modes charge in update_db_reqs
+            return
+        # Charged up front by count_request, given back with the update's other writes
+        staged = record if record is not None else UserRecord(self.user_id, self.bot_id)
+        staged.add(self.daily_col, -refund)
+        if record is None:
+            await self.db.flush_user_record(staged)
+
+    async def update_db_reqs(self, record: UserRecord = None):
+        if self.mode == "atomic":
+            # Already counted by get_current_reqs
+            return
+        if self.mode == "local":
+            # Counted in memory, written by the periodic sync
+            self.store.hit(self._counter, str(self.current_timestamp), self.cost)
+            await self.store.sync(self.db)
+            return
+        # Staged on the record so it goes out with the rest of the update's writes
+        staged = record if record is not None else UserRecord(self.user_id, self.bot_id)
+        staged.set(self.daily_col, int(self.daily_requests + self.cost))
+        staged.set(self.last_act_col, str(self.current_timestamp))
+        staged.add(self.total_col, 1)
+        if record is None:
+            await self.db.flush_user_record(staged)
 
     def get_time_until_reset(self):
         """
         Calculate the time remaining until the daily rate limit resets.
         """
-        reset_time = (86400 - (int(self.current_timestamp) % 86400)) // 60
+        now = datetime.fromtimestamp(int(self.current_timestamp), parse_timezone(self.timezone))
+        seconds_today = now.hour * 3600 + now.minute * 60 + now.second
+        reset_time = (86400 - seconds_today) // 60
         hours, minutes = divmod(reset_time, 60)
         return f"{hours} hours and {minutes} minutes" if hours else f"{minutes} minutes"
 
     def is_max_reached(self):
-        return self.daily_requests >= self.max_reqs_allowed
+        return self.daily_requests + self.cost > self.max_reqs_allowed
+
+    def use_quota(self, kind: str, record: UserRecord) -> bool:
+        """
+        Take one unit of a separate daily cap (e.g. "llm", "scan"). Returns False,
+        without using it, when today's cap is already reached. Kinds without a cap
+        are unlimited.
+        """
+        cap = self.quota_caps.get(kind)
+        if cap is None:
+            return True
+        today = get_date_with_tz(self.timezone)
+        quotas = dict(record.get("quotas") or {})
+        if quotas.get("day") != today:
+            quotas = {"day": today}
+        if quotas.get(kind, 0) >= cap:
+            return False
+        quotas[kind] = quotas.get(kind, 0) + 1
+        # Goes out with the update's other writes
+        record.set("quotas", quotas)
+        return True
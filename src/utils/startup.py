@@ -0,0 +1,85 @@
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable
+
+# label -> milliseconds spent importing/building it in this container
+STARTUP_TIMES: Dict[str, float] = {}
+
+
+@contextmanager
+def timed(label: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STARTUP_TIMES[label] = round((time.perf_counter() - start) * 1000, 2)
+
+
+def startup_report() -> Dict[str, float]:
+    """Recorded import/initialization times, slowest first."""
+    return dict(sorted(STARTUP_TIMES.items(), key=lambda kv: kv[1], reverse=True))
+
+
+class Lazy:
+    """
+    Builds a resource on first use instead of at import time, and records how long
+    the construction took in the startup report.
+    """
+
+    def __init__(self, label: str, factory: Callable):
+        self.label = label
+        self.factory = factory
+        self._value = None
+
+    @property
+    def is_built(self) -> bool:
+        return self._value is not None
+
+    def get(self):
+        if self._value is None:
+            with timed(self.label):
+                self._value = self.factory()
+        return self._value
+
+
+def measure_cold_imports(modules: Iterable[str], python: str = sys.executable) -> Dict[str, float]:
+    """
+    Cumulative import time (ms) of each module, measured in a fresh interpreter with
+    `-X importtime` so every module is timed as a true cold import.
+    """
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    report = {}
+    for module in modules:
+        proc = subprocess.run(
+            [python, "-X", "importtime", "-c", f"import {module}"],
+            capture_output=True,
+            text=True,
+            cwd=src_dir,
+        )
+        for line in proc.stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) == 3 and parts[2].strip() == module:
+                report[module] = int(parts[1]) / 1000
+    return report
+
+
+if __name__ == "__main__":
+    for module, ms in measure_cold_imports(
+        [
+            "telegram.ext",
+            "boto3",
+            "openai",
+            "utils.db",
+            "utils.llm",
+            "handlers.commands",
+            "handlers.callbacks",
+            "handlers.messages",
+            "handlers.admins",
+            "handlers.payments",
+            "handlers.scheduled",
+        ]
+    ).items():
+        print(f"{module:25} {ms:10.1f} ms")
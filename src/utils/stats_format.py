@@ -16,11 +16,16 @@ def graph_weekly_expenses(expenses_list, window="daily", max_bars=10):
     """
     Graphs expenses as a horsizontal bar chart using characters.
     """
+    return graph_expenses_by_date(group_and_sum_by_key(expenses_list), window, max_bars)
+
+
+def graph_expenses_by_date(expenses_by_date: dict, window="daily", max_bars=10):
+    """
+    Same as graph_weekly_expenses, from amounts already summed by 'YYYY-MM-DD' date.
+    """
     if window not in {"daily", "weekly", "monthly"}:
         raise ValueError("Invalid window value. Choose from 'daily', 'weekly', or 'monthly'.")
 
-    expenses_by_date = group_and_sum_by_key(expenses_list)
-
     parsed_data = {
         datetime.strptime(date_str, "%Y-%m-%d"): float(amount)
         for date_str, amount in expenses_by_date.items()
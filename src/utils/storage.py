@@ -0,0 +1,470 @@
+import contextvars
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, date
+from decimal import Decimal
+from typing import List, Dict, Any, Union, Optional, Iterator, Tuple
+from uuid import uuid4
+from utils.dates import parse_timezone, get_str_timestamp
+from utils.throttle import bulk_work
+from utils.user_record import UserRecord
+
+
+class ConditionFailed(Exception):
+    """A conditional write was rejected because the stored item changed."""
+
+
+# Expense attributes the rollups are computed from
+ROLLUP_FIELDS = ["user_id", "date", "amount", "category"]
+# Period of the rollup item marking a user's rollups as built
+ROLLUPS_READY = "READY"
+
+
+def fmt_date(value: Union[str, date]) -> str:
+    """Dates are stored as YYYY-MM-DD strings."""
+    if isinstance(value, date):
+        return value.strftime("%Y-%m-%d")
+    return value
+
+
+class BaseExpenseDB(ABC):
+    """
+    Storage interface used by the handlers. Backends implement the table access,
+    the shared logic (user record caching, rollup maths, record building) lives here.
+
+    Items have the DynamoDB shape in every backend: amounts are Decimal, dates are
+    YYYY-MM-DD strings and expense keys are (user_id, timestamp).
+    """
+
+    # Size of the worker pool AsyncExpenseDB runs blocking calls on
+    max_pool_connections: int = 10
+    # Concurrent batch writers and keys per batch used by purge_expenses
+    purge_workers: int = 4
+    purge_chunk_size: int = 25
+
+    @abstractmethod
+    def create_tables(self) -> None: ...
+
+    # ##############################################################
+    # Users
+    # ##############################################################
+
+    @abstractmethod
+    def get_user(self, user_id: str, bot_id: str) -> Optional[Dict[str, Any]]:
+        """Fetch the full Users item, or None if the user is not registered."""
+
+    @abstractmethod
+    def put_user(self, item: Dict[str, Any]) -> None: ...
+
+    @abstractmethod
+    def _get_user_fields(self, user_id: str, bot_id: str, fields: List[str]) -> Dict[str, Any]:
+        """Return the requested fields of a user (missing ones are left out)."""
+
+    @abstractmethod
+    def _update_user(
+        self,
+        user_id: str,
+        bot_id: str,
+        set_values: Dict[str, Any],
+        add_values: Dict[str, Union[int, float]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Apply SET and ADD actions to a user in a single write and return the new
+        values of the updated attributes.
+        """
+
+    @abstractmethod
+    def delete_user(self, user_id: str, bot_id: str) -> None: ...
+
+    @abstractmethod
+    def get_fields_by_bot(self, bot_id: str, fields=["user_id"]) -> List[Dict[str, Any]]: ...
+
+    @abstractmethod
+    def get_users_bulk(
+        self, user_ids: List[str], bot_id: str, fields: List[str]
+    ) -> Dict[str, Dict[str, Any]]: ...
+
+    @abstractmethod
+    def get_users_with_reminders(self, bot_id: str) -> List[str]: ...
+
+    def load_user_record(self, user_id: str, bot_id: str) -> UserRecord:
+        return UserRecord(user_id, bot_id, self.get_user(user_id, bot_id))
+
+    def get_fields(
+        self,
+        user_id: str,
+        bot_id: str,
+        fields: Union[str, List[str]],
+        record: UserRecord = None,
+    ) -> Union[Any, Dict[str, Any], None]:
+        # Served from the per-update cache when the caller already loaded the user
+        if record is not None:
+            return record.get(fields)
+        if isinstance(fields, str):
+            fields = [fields]
+
+        item = self._get_user_fields(user_id, bot_id, fields)
+
+        if len(fields) == 1:
+            return item.get(fields[0])
+        return item
+
+    def update_field(
+        self, user_id: str, bot_id: str, field: str, value: Any, record: UserRecord = None
+    ) -> None:
+        self.update_multiple_fields(user_id, bot_id, {field: value}, record=record)
+
+    def update_multiple_fields(
+        self, user_id: str, bot_id: str, updates: dict[str, Any], record: UserRecord = None
+    ) -> None:
+        # With a record the write is deferred to flush_user_record at the end of the update
+        if record is not None:
+            for key, val in updates.items():
+                record.set(key, val)
+            return
+        self._update_user(user_id, bot_id, updates)
+
+    def flush_user_record(self, record: UserRecord) -> None:
+        """
+        Write every SET/ADD staged on the record during the update as one write.
+        """
+        if record.deleted or not record.is_dirty:
+            return
+        updated = self._update_user(
+            record.user_id, record.bot_id, record.pending_set, record.pending_add
+        )
+        record.clear_pending()
+        # ADD results reflect writes from other containers too
+        record.apply(updated)
+
+    # Categories are updated in place (one map entry per write), never rewritten whole
+
+    @abstractmethod
+    def _set_categories_active(self, user_id: str, bot_id: str, states: Dict[str, int]) -> None:
+        """
+        Set the active flag of existing categories. Raises ConditionFailed if one of
+        them does not exist.
+        """
+
+    @abstractmethod
+    def _put_category(
+        self, user_id: str, bot_id: str, cat_id: str, category: Dict[str, Any], seen_count: int
+    ) -> None:
+        """
+        Add a category, provided the id is new and the map still has seen_count
+        entries (no concurrent add). Raises ConditionFailed otherwise.
+        """
+
+    def set_categories_active(
+        self, user_id: str, bot_id: str, states: Dict[str, int], record: UserRecord = None
+    ) -> None:
+        if not states:
+            return
+        self._set_categories_active(user_id, bot_id, states)
+        if record is not None:
+            for cat_id, active in states.items():
+                record.item["categories"][cat_id]["active"] = active
+
+    def add_category(
+        self,
+        user_id: str,
+        bot_id: str,
+        cat_id: str,
+        category: Dict[str, Any],
+        seen_count: int,
+        record: UserRecord = None,
+    ) -> None:
+        self._put_category(user_id, bot_id, cat_id, category, seen_count)
+        if record is not None:
+            record.item.setdefault("categories", {})[cat_id] = category
+
+    @abstractmethod
+    def count_request(
+        self, user_id: str, bot_id: str, day: str, cap: int, timestamp: str, cost: int = 1
+    ) -> Tuple[bool, int]:
+        """
+        Atomically add the request's cost to the user's daily bucket (reset when the
+        day differs), unless the bucket already reached cap. Returns whether it was
+        counted and the bucket's count.
+        """
+
+    def add_activity(self, user_id: str, bot_id: str) -> None:
+        self._update_user(
+            user_id, bot_id, {"last_active": get_str_timestamp()}, {"total_requests": 1}
+        )
+
+    # ##############################################################
+    # Expenses
+    # ##############################################################
+
+    @abstractmethod
+    def _put_expense(self, item: Dict[str, Any]) -> None:
+        """Store the expense and add it to its rollups in one transaction."""
+
+    @abstractmethod
+    def iter_expenses(
+        self,
+        user_id: str,
+        start_date: Union[str, date],
+        end_date: Union[str, date],
+        page_size: int = 500,
+        fields: List[str] = None,
+    ) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Yield pages of expenses in date order until the whole range has been read.
+        Only one page is held in memory at a time. With fields, only those attributes
+        are fetched.
+        """
+
+    @abstractmethod
+    def get_expense(self, user_id: str, timestamp: str) -> Optional[Dict[str, Any]]: ...
+
+    @abstractmethod
+    def fetch_latest_expenses(
+        self, user_id: str, limit: int = 50, ascending=False, fields: List[str] = None
+    ) -> List[Dict[str, Any]]:
+        """Fetch the most recent expenses for a user (only the given fields, if any)."""
+
+    @abstractmethod
+    def remove_expense(self, user_id: str, timestamp: str) -> Optional[Dict[str, Any]]:
+        """
+        Remove an expense record by user_id and timestamp and subtract it from its
+        rollups in one transaction. Returns the deleted item, or None if there was none.
+        """
+
+    @abstractmethod
+    def remove_batch_records(self, records: dict) -> bool: ...
+
+    @abstractmethod
+    def insert_batch_records(self, records: list) -> bool: ...
+
+    @abstractmethod
+    def _delete_expense_keys(self, keys: List[Dict[str, str]]) -> None:
+        """
+        Delete up to purge_chunk_size expenses by (user_id, timestamp), retrying
+        whatever the backend leaves unprocessed. Called from several threads.
+        """
+
+    def insert_expense(
+        self,
+        user_id: str,
+        amount: float,
+        category: str,
+        currency: str,
+        description: str = "",
+        income: bool = False,
+        timezone: str = "UTC-6",
+    ) -> None:
+        # Parse the timezone string (e.g., "UTC-6" or "UTC+3")
+        tz = parse_timezone(timezone)
+        current_time = datetime.now(tz)
+        uid = str(uuid4())[:7]
+        timestamp = str(int(current_time.timestamp()))
+        date_str = current_time.strftime("%Y-%m-%d")
+
+        item = {
+            "user_id": user_id,
+            "timestamp": f"{timestamp}_{uid}",
+            "date": date_str,
+            "amount": Decimal(str(amount)),
+            "category": category,
+            "currency": currency,
+            "description": description,
+            "income": income,
+        }
+        self._put_expense(item)
+
+    def fetch_expenses_by_user_and_date(
+        self,
+        user_id: str,
+        start_date: Union[str, date],
+        end_date: Union[str, date],
+        ascending: bool = True,
+        fields: List[str] = None,
+    ) -> List[Dict[str, Any]]:
+        if fields is not None:
+            # Needed for the sort below
+            fields = list(dict.fromkeys([*fields, "timestamp"]))
+        items = [
+            item
+            for page in self.iter_expenses(user_id, start_date, end_date, fields=fields)
+            for item in page
+        ]
+
+        # Sort items by timestamp
+        items.sort(key=lambda x: x["timestamp"], reverse=not ascending)
+
+        return items
+
+    def delete_last_record(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Remove the most recent expense and return it (None if there are none)."""
+        latest = self.fetch_latest_expenses(user_id, limit=1, fields=["timestamp"])
+        if not latest:
+            return None
+        return self.remove_expense(user_id, latest[0]["timestamp"])
+
+    @bulk_work()
+    def purge_expenses(
+        self,
+        user_id: str,
+        start_date: Union[str, date] = None,
+        end_date: Union[str, date] = None,
+        category: str = None,
+    ) -> int:
+        """
+        Delete the user's expenses, optionally only those in a date range and/or of one
+        category, and return how many were deleted. Pages are streamed and their keys
+        deleted by purge_workers concurrent batch writers while the next page is read.
+
+        Batch deletes can't share a transaction with the rollups: they are marked as
+        not built first and replaced at the end, so an interrupted purge leaves them
+        to ensure_rollups.
+        """
+        everything = start_date is None and end_date is None and category is None
+        # Only the keys are needed (and the category, to filter on it)
+        fields = ["user_id", "timestamp", *([] if category is None else ["category"])]
+        self._invalidate_rollups(user_id)
+        deleted = 0
+        pending = None
+        with ThreadPoolExecutor(self.purge_workers, thread_name_prefix="purge") as pool:
+            for page in self.iter_expenses(
+                user_id,
+                start_date or "1900-01-01",
+                end_date or "2100-12-31",
+                page_size=1000,
+                fields=fields,
+            ):
+                if category is not None:
+                    page = [item for item in page if item["category"] == category]
+                futures = [
+                    # Workers keep the caller's context: bulk pacing, handler metrics
+                    pool.submit(
+                        contextvars.copy_context().run,
+                        self._delete_expense_keys,
+                        [
+                            {"user_id": item["user_id"], "timestamp": item["timestamp"]}
+                            for item in page[i : i + self.purge_chunk_size]
+                        ],
+                    )
+                    for i in range(0, len(page), self.purge_chunk_size)
+                ]
+                if pending:
+                    deleted += self._finish_purge_page(*pending)
+                pending = (futures, page)
+            if pending:
+                deleted += self._finish_purge_page(*pending)
+
+        if everything:
+            self._replace_rollups(user_id, {})
+        else:
+            self.rebuild_rollups(user_id)
+        return deleted
+
+    def _finish_purge_page(self, futures: List[Future], page: List[Dict[str, Any]]) -> int:
+        for future in futures:
+            future.result()
+        return len(page)
+
+    def delete_account(self, user_id: str, bot_id: str) -> int:
+        """
+        Delete every expense and rollup of the user and its Users item. Expenses are
+        keyed by user only, so this also clears them for the user's other bots.
+        """
+        deleted = self.purge_expenses(user_id)
+        self.delete_user(user_id, bot_id)
+        return deleted
+
+    def summarize_by_category(self, expenses: List[Dict[str, Any]]) -> Dict[str, float]:
+        summary = {}
+        for item in expenses:
+            category = item.get("category", "uncategorized")
+            amount = float(item.get("amount", 0))
+            if not item.get("income", False):
+                summary[category] = summary.get(category, 0) + amount
+            else:
+                # Track income separately with a special category
+                summary["💰 Income"] = summary.get("💰 Income", 0) + amount
+        return summary
+
+    # ##############################################################
+    # Rollups: per user totals by day ("D#YYYY-MM-DD") and month ("M#YYYY-MM")
+    # ##############################################################
+
+    @abstractmethod
+    def iter_rollups(
+        self,
+        user_id: str,
+        granularity: str,
+        start_date: Union[str, date],
+        end_date: Union[str, date],
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yield rollup items of granularity "D" (daily) or "M" (monthly) in period order.
+        """
+
+    @abstractmethod
+    def _replace_rollups(self, user_id: str, deltas: Dict[tuple, dict]) -> None:
+        """
+        Drop every rollup item of the user, store the given ones instead and mark the
+        rollups as built.
+        """
+
+    @abstractmethod
+    def _rollups_ready(self, user_id: str) -> bool:
+        """Whether the user's rollups were built (the ROLLUPS_READY item exists)."""
+
+    @abstractmethod
+    def _invalidate_rollups(self, user_id: str) -> None:
+        """Drop the ROLLUPS_READY item, the next ensure_rollups rebuilds them."""
+
+    @staticmethod
+    def _rollup_deltas(records: List[Dict[str, Any]], sign: int = 1) -> Dict[tuple, dict]:
+        """
+        Aggregate the counter deltas of a list of expenses by (user_id, period): the
+        amount ("cat_<id>") and number ("cnt_<id>") of records of each category. Income
+        is told apart when reading, by category name like the stats always did.
+        """
+        deltas = defaultdict(lambda: defaultdict(Decimal))
+        for item in records:
+            amount = Decimal(str(item["amount"])) * sign
+            for period in (f"D#{item['date']}", f"M#{item['date'][:7]}"):
+                counters = deltas[(item["user_id"], period)]
+                counters[f"cat_{item['category']}"] += amount
+                counters[f"cnt_{item['category']}"] += sign
+        return deltas
+
+    @bulk_work()
+    def rebuild_rollups(self, user_id: str) -> None:
+        """
+        Recompute every rollup item of a user from the expenses (backfill/repair).
+        """
+        deltas = defaultdict(lambda: defaultdict(Decimal))
+        for page in self.iter_expenses(user_id, "1900-01-01", "2100-12-31", fields=ROLLUP_FIELDS):
+            for key, counters in self._rollup_deltas(page).items():
+                for name, value in counters.items():
+                    deltas[key][name] += value
+        self._replace_rollups(user_id, deltas)
+
+    def ensure_rollups(self, user_id: str) -> None:
+        """
+        Build the user's rollups on first use. Users who saved expenses before rollups
+        existed (or before their layout changed) have none until then.
+        """
+        if not self._rollups_ready(user_id):
+            self.rebuild_rollups(user_id)
+
+    # ##############################################################
+    # Processed updates (webhook redelivery dedup)
+    # ##############################################################
+
+    @abstractmethod
+    def claim_update(self, bot_id: str, update_id: int, ttl_seconds: int = 86400) -> bool:
+        """
+        Mark an update as being processed. Returns False if it was already claimed
+        within the last ttl_seconds (a redelivery).
+        """
+
+    @abstractmethod
+    def release_update(self, bot_id: str, update_id: int) -> None:
+        """Drop the claim of an update that failed, so its redelivery is processed."""
@@ -0,0 +1,162 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+# Error codes DynamoDB returns when a request should be retried later
+RETRYABLE_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "InternalServerError",
+    "ServiceUnavailable",
+    "TransactionConflictException",
+}
+
+# CancellationReasons of a cancelled TransactWriteItems worth retrying
+TRANSIENT_CANCELLATIONS = {
+    "TransactionConflict",
+    "ThrottlingError",
+    "ProvisionedThroughputExceeded",
+}
+
+
+# Set while running bulk work (purges, rollup rebuilds, scheduled jobs)
+_bulk: ContextVar[bool] = ContextVar("bulk", default=False)
+
+
+@contextmanager
+def bulk_work():
+    """
+    Storage calls made inside are paced by the governor. Interactive calls are not
+    paced, they only pay their capacity, so bulk work yields to them.
+    """
+    token = _bulk.set(True)
+    try:
+        yield
+    finally:
+        _bulk.reset(token)
+
+
+def is_bulk() -> bool:
+    return _bulk.get()
+
+
+def parse_capacity(spec: str) -> Dict[str, Tuple[float, float]]:
+    """
+    (RCU, WCU) by table or index from "Expenses=5:5,Expenses/UserDateIndex=5:5".
+    Each container paces itself, so give it its share of the provisioned capacity.
+    """
+    capacity = {}
+    for entry in filter(None, (e.strip() for e in spec.split(","))):
+        name, units = entry.split("=")
+        rcu, wcu = units.split(":")
+        capacity[name.strip()] = (float(rcu), float(wcu))
+    return capacity
+
+
+def backoff_delay(attempt: int, base: float = 0.05, cap: float = 5) -> float:
+    """Full-jitter exponential backoff."""
+    return random.uniform(0, min(base * 2**attempt, cap))
+
+
+class TokenBucket:
+    """
+    Capacity units per second for one table or index and one kind (read/write).
+
+    The cost of a request is only known from its ConsumedCapacity, so callers wait
+    until the bucket is out of debt and pay the actual units afterwards. Unused
+    capacity accumulates up to burst_seconds like DynamoDB burst capacity. On
+    throttling the rate is halved, then it recovers towards the provisioned rate.
+    """
+
+    def __init__(self, rate: float, burst_seconds: float = 300):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst_seconds = burst_seconds
+        self.tokens = rate * burst_seconds
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.tokens + (now - self.updated) * self.rate, self.max_rate * self.burst_seconds
+        )
+        self.updated = now
+
+    def wait(self) -> float:
+        """Block until the bucket is out of debt, returns the seconds waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens > 0:
+                    return waited
+                delay = -self.tokens / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def consume(self, units: float) -> None:
+        with self.lock:
+            self._refill()
+            self.tokens -= units
+            # Additive recovery after a throttle
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def throttled(self) -> None:
+        with self.lock:
+            self._refill()
+            self.rate = max(self.max_rate * 0.05, self.rate / 2)
+            self.tokens = min(self.tokens, 0)
+
+
+class ThroughputGovernor:
+    """
+    Token buckets per table and per index ("Table/Index"), configured with the
+    provisioned read and write capacity units. Names without a configured capacity
+    (on-demand tables) are not paced.
+    """
+
+    def __init__(self, capacity: Dict[str, Tuple[float, float]], burst_seconds: float = 300):
+        self.buckets = {
+            (name, kind): TokenBucket(units, burst_seconds)
+            for name, (rcu, wcu) in capacity.items()
+            for kind, units in (("read", rcu), ("write", wcu))
+            if units
+        }
+
+    def _targets(self, table: str, kind: str, index: str = None) -> List[TokenBucket]:
+        if kind == "read":
+            # Reads only touch the table or the queried index
+            names = [f"{table}/{index}" if index else table]
+            return [self.buckets[(n, kind)] for n in names if (n, kind) in self.buckets]
+        # Writes also consume the write capacity of every index of the table
+        return [
+            bucket
+            for (name, bucket_kind), bucket in self.buckets.items()
+            if bucket_kind == kind and (name == table or name.startswith(f"{table}/"))
+        ]
+
+    def wait(self, table: str, kind: str, index: str = None) -> float:
+        return sum(bucket.wait() for bucket in self._targets(table, kind, index))
+
+    def throttled(self, table: str, kind: str, index: str = None) -> None:
+        for bucket in self._targets(table, kind, index):
+            bucket.throttled()
+
+    def record(self, consumed: Optional[Union[Dict[str, Any], List[Dict[str, Any]]]]) -> None:
+        """Pay the units of a ConsumedCapacity (ReturnConsumedCapacity=INDEXES) response."""
+        for entry in consumed if isinstance(consumed, list) else [consumed] if consumed else []:
+            table = entry["TableName"]
+            parts = [(table, entry.get("Table", entry))]
+            parts += [
+                (f"{table}/{index}", units)
+                for index, units in entry.get("GlobalSecondaryIndexes", {}).items()
+            ]
+            for name, units in parts:
+                for kind, key in (("read", "ReadCapacityUnits"), ("write", "WriteCapacityUnits")):
+                    if units.get(key) and (name, kind) in self.buckets:
+                        self.buckets[(name, kind)].consume(units[key])
@@ -0,0 +1,52 @@
+import asyncio
+from typing import Awaitable, Dict, Hashable, Optional
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+def update_key(update: object) -> Optional[Hashable]:
+    """Updates with the same key run one after another (None: no ordering needed)."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    return update.effective_chat.id if update.effective_chat else None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs up to `concurrency` updates at the same time, while the updates of a user
+    stay strictly ordered: handlers read-modify-write the user's conversation_status,
+    temp_data and categories. Updates waiting for their user's previous update don't
+    take a running slot; at most `backlog` updates are waiting or running overall.
+    """
+
+    def __init__(self, concurrency: int = 16, backlog: int = 1024):
+        super().__init__(max(backlog, concurrency))
+        self.concurrency = concurrency
+        self._running = asyncio.Semaphore(concurrency)
+        # key -> (lock, number of updates holding or waiting for it)
+        self._locks: Dict[Hashable, list] = {}
+
+    async def do_process_update(self, update: object, coroutine: Awaitable) -> None:
+        key = update_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes its waiters in FIFO order, which keeps the update order
+            async with entry[0], self._running:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
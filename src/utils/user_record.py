@@ -0,0 +1,58 @@
+from typing import Any, Dict, List, Union
+
+
+class UserRecord:
+    """
+    Users-table item for one (user_id, bot_id), read once per update and shared
+    by the decorators and handlers that process it.
+
+    Writes made through the record are staged as SET/ADD actions and sent to the
+    Users table as a single write by flush_user_record.
+    """
+
+    def __init__(self, user_id: str, bot_id: str, item: Dict[str, Any] = None):
+        self.user_id = str(user_id)
+        self.bot_id = str(bot_id)
+        self.exists = item is not None
+        self.deleted = False
+        self.item = dict(item or {})
+        self.pending_set: Dict[str, Any] = {}
+        self.pending_add: Dict[str, Union[int, float]] = {}
+
+    @property
+    def key(self) -> Dict[str, str]:
+        return {"user_id": self.user_id, "bot_id": self.bot_id}
+
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self.pending_set or self.pending_add)
+
+    def get(self, fields: Union[str, List[str]]) -> Union[Any, Dict[str, Any], None]:
+        """Same return shape as get_fields."""
+        if isinstance(fields, str):
+            fields = [fields]
+        if len(fields) == 1:
+            return self.item.get(fields[0])
+        return {f: self.item[f] for f in fields if f in self.item}
+
+    def apply(self, updates: Dict[str, Any]) -> None:
+        """Keep the cached item in sync with a write already made to the table."""
+        self.item.update(updates)
+
+    def set(self, field: str, value: Any) -> None:
+        self.pending_set[field] = value
+        self.item[field] = value
+
+    def add(self, field: str, value: Union[int, float]) -> None:
+        self.pending_add[field] = self.pending_add.get(field, 0) + value
+        self.item[field] = self.item.get(field, 0) + value
+
+    def mark_deleted(self) -> None:
+        """The user was removed; nothing staged on the record may recreate it."""
+        self.deleted = True
+        self.exists = False
+        self.clear_pending()
+
+    def clear_pending(self) -> None:
+        self.pending_set = {}
+        self.pending_add = {}
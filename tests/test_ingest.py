@@ -0,0 +1,68 @@
+import asyncio
+from utils.ingest import InMemoryQueue, process_batch
+
+
+def _message(update_id, user_id, text):
+    return {"update_id": update_id, "message": {"from": {"id": user_id}, "text": text}}
+
+
+def _run(queue, handle):
+    event = queue.receive()
+    response = asyncio.run(process_batch(event["Records"], handle))
+    return event, response
+
+
+def test_updates_of_a_user_keep_their_order():
+    queue = InMemoryQueue(batch_size=20)
+    for i in range(12):
+        queue.send(_message(i, i % 3, f"msg {i}"))
+    seen = []
+
+    async def handle(body):
+        # Earlier updates take longer, so only the per-user ordering keeps them first
+        await asyncio.sleep(0.001 * (12 - body["update_id"]))
+        seen.append((body["message"]["from"]["id"], body["update_id"]))
+
+    _, response = _run(queue, handle)
+    assert response == {"batchItemFailures": []}
+    for user_id in range(3):
+        ids = [update_id for user, update_id in seen if user == user_id]
+        assert ids == sorted(ids) and len(ids) == 4
+
+
+def test_failure_fails_the_later_updates_of_the_same_user_only():
+    queue = InMemoryQueue()
+    ids = {
+        key: queue.send(_message(n, user_id, text))
+        for n, (key, user_id, text) in enumerate(
+            [("a1", 1, "ok"), ("b1", 2, "ok"), ("a2", 1, "fail"), ("a3", 1, "ok"), ("b2", 2, "ok")]
+        )
+    }
+    handled = []
+
+    async def handle(body):
+        if body["message"]["text"] == "fail":
+            raise RuntimeError("boom")
+        handled.append(body["update_id"])
+
+    event, response = _run(queue, handle)
+    failed = [f["itemIdentifier"] for f in response["batchItemFailures"]]
+    assert failed == [ids["a2"], ids["a3"]]
+    # a3 never ran, user 2 was not affected
+    assert sorted(handled) == [0, 1, 4]
+
+    # The failures go back to the queue in their order
+    queue.requeue(event, response)
+    assert [r["messageId"] for r in queue.receive()["Records"]] == failed
+
+
+def test_malformed_bodies_are_dropped():
+    queue = InMemoryQueue()
+    queue.send(_message(1, 1, "ok"))
+    queue.messages.append({"messageId": "bad", "body": "not json", "eventSource": "aws:sqs"})
+
+    async def handle(body):
+        pass
+
+    _, response = _run(queue, handle)
+    assert response == {"batchItemFailures": []}
@@ -0,0 +1,91 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from handlers._decorators import rate_counter
+from utils.async_db import AsyncExpenseDB
+from utils.db_sqlite import SQLiteExpenseDB
+from utils.rate_limiter import LocalRateStore
+
+USER_ID = 42
+BOT_ID = 7
+
+MODES = ["db", "local", "atomic"]
+
+
+class _User:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.sent = []
+
+    async def send_message(self, text, **kwargs):
+        self.sent.append(text)
+
+
+def _bot_data(tmp_path, mode, requests_per_day=100):
+    db = SQLiteExpenseDB(str(tmp_path / "expenses.db"))
+    db.put_user({"user_id": str(USER_ID), "bot_id": str(BOT_ID), "user_timezone": "UTC+3"})
+    return {
+        "db": AsyncExpenseDB(db),
+        "admins": [],
+        "requests_per_day": requests_per_day,
+        "quotas_per_day": {"scan": 1},
+        "rate_limit_mode": mode,
+        # Synced on every update so the stored counters can be checked
+        "rate_store": LocalRateStore(sync_interval=0) if mode == "local" else None,
+    }
+
+
+def _send(handler, bot_data):
+    user = _User(USER_ID)
+    update = SimpleNamespace(effective_user=user, callback_query=None)
+    context = SimpleNamespace(bot_data=bot_data, bot=SimpleNamespace(id=BOT_ID))
+    asyncio.run(handler(update, context))
+    return user.sent
+
+
+def _daily_requests(bot_data):
+    return bot_data["db"].sync.get_user(str(USER_ID), str(BOT_ID)).get("daily_requests")
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_quota_refusal_counts_one_request(tmp_path, mode):
+    bot_data = _bot_data(tmp_path, mode)
+    runs = []
+
+    @rate_counter(cost=10, quota="scan")
+    async def scan(update, context):
+        runs.append(update.effective_user.id)
+
+    assert _send(scan, bot_data) == []
+    assert _daily_requests(bot_data) == 10
+    # The scan quota (1 a day) is used up: refused without running, charged as 1
+    sent = _send(scan, bot_data)
+    assert "Daily limit reached" in sent[0]
+    assert runs == [USER_ID]
+    assert _daily_requests(bot_data) == 11
+
+
+@pytest.mark.parametrize("mode", MODES)
+def test_daily_limit_refusal_counts_one_request(tmp_path, mode):
+    bot_data = _bot_data(tmp_path, mode, requests_per_day=12)
+    runs = []
+
+    @rate_counter(cost=5)
+    async def report(update, context):
+        runs.append(update.effective_user.id)
+
+    @rate_counter
+    async def cheap(update, context):
+        runs.append(update.effective_user.id)
+
+    _send(report, bot_data)
+    _send(report, bot_data)
+    assert _daily_requests(bot_data) == 10
+    # 10 + 5 is over the limit of 12: refused, charged as 1
+    sent = _send(report, bot_data)
+    assert "Limit reached" in sent[0]
+    assert _daily_requests(bot_data) == 11
+    # A cost 1 handler still fits
+    assert _send(cheap, bot_data) == []
+    assert len(runs) == 3
+    assert _daily_requests(bot_data) == 12
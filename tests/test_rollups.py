@@ -0,0 +1,155 @@
+import asyncio
+import re
+import pytest
+from decimal import Decimal
+from config import DEFAULT_CATEGORIES, STATS_WINDOWS
+from handlers.callbacks import _get_stats_report
+from utils.async_db import AsyncExpenseDB
+from utils.db_sqlite import SQLiteExpenseDB
+from utils.stats_format import graph_weekly_expenses
+
+USER_ID = "42"
+BOT_ID = "7"
+CUTOFF = "2024-03-20"
+
+CATEGORIES = {**DEFAULT_CATEGORIES, "20": {"name": "Side income", "active": 1}}
+
+# (date, amount, category, income flag); income rows older than the flag don't carry it
+ROWS = [
+    ("2023-11-02", "12.50", "0", False),
+    ("2023-12-24", "300", "99", False),
+    ("2024-01-15", "45.10", "5", False),
+    ("2024-01-31", "1200", "99", True),
+    ("2024-03-01", "80", "2", False),
+    ("2024-03-18", "19.99", "0", False),
+    ("2024-03-18", "150", "20", False),
+    ("2024-03-20", "7.25", "1", False),
+    ("2024-03-20", "60", "99", True),
+    ("2024-03-20", "5", "13", True),
+]
+
+
+def _full_scan_report(db, window):
+    """The stats as they were computed before rollups: every record, income by name."""
+    end = CUTOFF
+    start = {
+        "Today": CUTOFF,
+        "This Week": "2024-03-18",
+        "This Month": "2024-03-01",
+        "This Year": "2024-01-01",
+        "All Time": "1900-03-20",
+    }[window]
+    data = db.fetch_expenses_by_user_and_date(USER_ID, start, end)
+    if not data:
+        return "No records found for the selected time window."
+    exp, inc = [], []
+    exp_total = inc_total = 0
+    for i in data:
+        i["category"] = CATEGORIES[i["category"]]["name"]
+        if not re.search(r"(?i).*income", i["category"]):
+            exp.append(i)
+            exp_total += i["amount"]
+        else:
+            inc.append(i)
+            inc_total += i["amount"]
+    daily = window in ("Today", "This Week", "This Month")
+    if exp:
+        msg = graph_weekly_expenses(exp, window="daily" if daily else "monthly", max_bars=10)
+    else:
+        msg = "No expenses to show.\n"
+    sign = "-" if exp_total > inc_total else "+"
+    net = exp_total - inc_total
+    return f"""
+                📊 <b>Stats for {window}</b>:\n
+<b>➖ Expenses</b>\n\n{msg}\n
+<b>Total Expenses: <code>${exp_total:,.2f}</code></b> ({len(exp)})\n
+<b>Total Income: <code>${inc_total:,.2f}</code></b> ({len(inc)})\n\n
+<b>Total Net: <code>{sign}${abs(net):,.2f}</code></b>
+                """
+
+
+def _db(tmp_path):
+    db = SQLiteExpenseDB(str(tmp_path / "expenses.db"))
+    db.put_user(
+        {"user_id": USER_ID, "bot_id": BOT_ID, "user_timezone": "UTC-6", "categories": CATEGORIES}
+    )
+    return db
+
+
+def _records(rows):
+    return [
+        {
+            "user_id": USER_ID,
+            "timestamp": f"{1700000000 + n}_abc{n}",
+            "date": day,
+            "amount": Decimal(amount),
+            "category": category,
+            "currency": "USD",
+            "description": "",
+            "income": income,
+        }
+        for n, (day, amount, category, income) in enumerate(rows)
+    ]
+
+
+def _reports(db):
+    async def run():
+        adb = AsyncExpenseDB(db)
+        return {
+            w: await _get_stats_report(adb, w, USER_ID, BOT_ID, cutoff_date=CUTOFF)
+            for w in STATS_WINDOWS
+        }
+
+    return asyncio.run(run())
+
+
+def test_rollup_stats_match_full_scan(tmp_path):
+    db = _db(tmp_path)
+    assert db.insert_batch_records(_records(ROWS))
+    reports = _reports(db)
+    for window in STATS_WINDOWS:
+        assert reports[window] == _full_scan_report(db, window), window
+
+
+def test_rollup_stats_match_full_scan_after_deletes(tmp_path):
+    db = _db(tmp_path)
+    records = _records(ROWS)
+    assert db.insert_batch_records(records)
+    db.remove_expense(USER_ID, records[3]["timestamp"])
+    db.purge_expenses(USER_ID, start_date="2024-03-18", end_date="2024-03-18")
+    db.purge_expenses(USER_ID, category="5")
+    reports = _reports(db)
+    for window in STATS_WINDOWS:
+        assert reports[window] == _full_scan_report(db, window), window
+
+
+def test_rollups_are_built_on_first_stats_request(tmp_path):
+    db = _db(tmp_path)
+    assert db.insert_batch_records(_records(ROWS))
+    # A user whose expenses predate the rollups
+    db.conn.execute("DELETE FROM rollups")
+    assert not db._rollups_ready(USER_ID)
+    reports = _reports(db)
+    assert db._rollups_ready(USER_ID)
+    for window in STATS_WINDOWS:
+        assert reports[window] == _full_scan_report(db, window), window
+
+
+def test_expense_writes_roll_back_with_their_rollups(tmp_path, monkeypatch):
+    db = _db(tmp_path)
+    records = _records(ROWS)
+    assert db.insert_batch_records(records)
+    before = _reports(db)
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("rollups unavailable")
+
+    monkeypatch.setattr(db, "_rollup_deltas", fail)
+    with pytest.raises(RuntimeError):
+        db.insert_expense(USER_ID, 10, "0", "USD")
+    with pytest.raises(RuntimeError):
+        db.remove_expense(USER_ID, records[0]["timestamp"])
+    monkeypatch.undo()
+
+    assert len(db.fetch_latest_expenses(USER_ID)) == len(ROWS)
+    assert _reports(db) == before
@@ -0,0 +1,82 @@
+import json
+import os
+import subprocess
+import sys
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+# Runs in a fresh interpreter, so modules imported by other tests don't count
+SCRIPT = """
+import json, sys
+import lambda_function as lf
+
+
+def loaded():
+    return {
+        "boto3": "boto3" in sys.modules,
+        "openai": "openai" in sys.modules,
+        "handlers": sorted(
+            m for m in sys.modules
+            if m.startswith("handlers.") and m not in ("handlers.registry", "handlers.router")
+        ),
+    }
+
+
+result = {"import": loaded()}
+lf.db.get()
+result["storage"] = loaded()
+lf.llm.get()
+result["llm"] = loaded()
+# What the router calls on the first update routed to /help
+lf.lazy("handlers.commands.help_handler").resolve()
+result["dispatch"] = loaded()
+result["report"] = lf.startup_report()
+print(json.dumps(result))
+"""
+
+REGISTRY_SCRIPT = """
+import json, sys
+from handlers.registry import HANDLER_MODULES, lazy
+
+handlers = [lazy(module + ".handler") for module in HANDLER_MODULES]
+result = {"registered": sorted(m for m in HANDLER_MODULES if m in sys.modules)}
+help_handler = lazy("handlers.commands.help_handler")
+result["shared"] = help_handler is lazy("handlers.commands.help_handler")
+help_handler.resolve()
+result["resolved"] = sorted(m for m in HANDLER_MODULES if m in sys.modules)
+print(json.dumps(result))
+"""
+
+
+def _run(script=SCRIPT):
+    env = {
+        k: v
+        for k, v in os.environ.items()
+        if k not in ("STORAGE_BACKEND", "INGEST_MODE", "RATE_LIMIT_MODE", "MY_ENVIRONMENT")
+    }
+    env.update(BOT_TOKEN="123456:test", MY_CHAT_ID="1", LLM_API_KEY="sk-test", PYTHONPATH=SRC)
+    out = subprocess.run(
+        [sys.executable, "-c", script], cwd=SRC, env=env, capture_output=True, text=True
+    )
+    assert out.returncode == 0, out.stderr
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def test_heavy_modules_load_on_first_use():
+    result = _run()
+    assert result["import"] == {"boto3": False, "openai": False, "handlers": []}
+    assert result["storage"] == {"boto3": True, "openai": False, "handlers": []}
+    assert result["llm"]["openai"] and result["llm"]["handlers"] == []
+    assert "handlers.commands" in result["dispatch"]["handlers"]
+
+    report = result["report"]
+    for label in ("import:telegram", "init:application", "init:storage", "init:llm"):
+        assert label in report
+    assert "import:handlers.commands.help_handler" in report
+
+
+def test_lazy_registration_imports_no_handler_module():
+    result = _run(REGISTRY_SCRIPT)
+    assert result["registered"] == []
+    assert result["shared"]
+    assert "handlers.commands" in result["resolved"]